@@ -0,0 +1,228 @@
+"""Asyncio interface to rabbit repositories.
+
+    async with AsyncRabbit() as r:
+        i_id = await r.add(Issue(summary='Segfault on program start'))
+        await r.comment(i_id, 'Only with an empty repository')
+        issue = await r.issue(i_id)
+
+"""
+
+import asyncio
+import queue
+import threading
+
+from rabbit import Rabbit, FileStorage
+
+
+def _resolve(future, result, error):
+    # runs on the event loop; the caller may have given up waiting
+    if future.cancelled():
+        return
+
+    if error is None:
+        future.set_result(result)
+    else:
+        future.set_exception(error)
+
+
+class AsyncRabbit:
+    """The operations of Rabbit, as coroutines that never block the event loop.
+
+    Work is done on a fixed set of threads, each with a Rabbit, and so a
+    connection, of its own: one writer, which runs every change in turn, so
+    changes never wait on each other for SQLite's lock, and several readers,
+    which run lookups at the same time as each other and the writer.
+    Readers only run alongside a commit in wal journal mode (rabbit config
+    journal_mode wal); otherwise they wait for it to finish.
+
+    Results are complete when returned. issues() returns full Issues, with
+    their comments, rather than IssueRows, which would read from a
+    connection belonging to another thread.
+
+    Call shutdown(), or use async with, to stop the threads and close the
+    connections.
+
+    """
+
+    def __init__(self, path=None, readers=4, storage=None):
+        """Start the worker threads. Connections are opened by each thread
+        when it first has work.
+
+        Keyword arguments:
+        path -- directory of the repository. Defaults to the nearest one, from
+                the working directory up
+        readers -- number of reader threads, and so read connections
+        storage -- where the repository is kept, e.g. a MemoryStorage, rather
+                   than in a file. path is ignored if this is given
+
+        """
+
+        self.storage = storage or FileStorage(path)
+        self.path = self.storage.path
+
+        self._reads = queue.Queue()
+        self._writes = queue.Queue()
+        self._threads = []
+
+        for n in range(readers):
+            self._start(self._reads, 'rabbit-reader-{}'.format(n))
+
+        self._start(self._writes, 'rabbit-writer')
+
+    def _start(self, jobs, name):
+        thread = threading.Thread(target=self._work, args=(jobs,), name=name, daemon=True)
+        thread.start()
+        self._threads.append((thread, jobs))
+
+    def _work(self, jobs):
+        r = None
+
+        while True:
+            job = jobs.get()
+
+            if job is None:
+                break
+
+            loop, future, operation = job
+
+            try:
+                if r is None:
+                    r = Rabbit(storage=self.storage)
+
+                result, error = operation(r), None
+            except Exception as e:
+                result, error = None, e
+
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+
+        if r is not None:
+            r.conn.close()
+            r.conn = None
+
+    def run(self, operation, write=False):
+        """Run operation, a function taking a Rabbit, on a worker thread, and
+        return its result.
+
+        Use this for anything the other methods don't cover, e.g. several
+        changes in one transaction:
+
+            await r.run(lambda rabbit: ..., write=True)
+
+        Keyword arguments:
+        operation -- function taking a Rabbit. Its result must not read from
+                     the Rabbit once returned
+        write -- True if operation changes the repository, so it runs on the
+                 writer
+
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        (self._writes if write else self._reads).put((loop, future, operation))
+
+        return future
+
+    async def shutdown(self):
+        """Finish the work already queued, then stop the threads and close
+        their connections."""
+
+        for thread, jobs in self._threads:
+            jobs.put(None)
+
+        for thread, jobs in self._threads:
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+
+        self._threads = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.shutdown()
+
+    # reads
+
+    async def issue(self, issue_id):
+        """Return a specific Issue, with its comments. See Rabbit.issue."""
+
+        return await self.run(lambda r: r.issue(issue_id))
+
+    async def issues(self, query='all', limit=None, after_id=0):
+        """Return a list of Issues matching a query, with their comments.
+
+        Keyword arguments:
+        query -- Query, or query string for parse_query, e.g. 'status:open sort:-date'
+        limit -- maximum number of issues to return, or None for no limit
+        after_id -- only issues after the issue with this id, in the query's order, are returned
+
+        """
+
+        return await self.run(lambda r: list(r.iter_issues(query, after_id=after_id, limit=limit, include_comments=True)))
+
+    async def search(self, query, limit=20):
+        """Return a list of SearchResults. See Rabbit.search."""
+
+        return await self.run(lambda r: r.search(query, limit))
+
+    async def stats(self):
+        """Return Stats for the repository. See Rabbit.stats."""
+
+        return await self.run(lambda r: r.stats())
+
+    async def changes(self, since_version=0, limit=None):
+        """Return a list of Changes after since_version. See Rabbit.changes."""
+
+        return await self.run(lambda r: r.changes(since_version, limit))
+
+    async def latest_change(self):
+        return await self.run(lambda r: r.latest_change())
+
+    async def settings(self):
+        return await self.run(lambda r: r.settings())
+
+    # writes
+
+    async def add(self, issue):
+        """Add a new issue, and return its id. See Rabbit.add."""
+
+        return await self.run(lambda r: r.add(issue), write=True)
+
+    async def add_many(self, issues, chunk_size=1000):
+        """Add many issues in a single transaction. See Rabbit.add_many.
+
+        issues is read on the writer thread.
+
+        """
+
+        return await self.run(lambda r: r.add_many(issues, chunk_size), write=True)
+
+    async def update(self, issue):
+        return await self.run(lambda r: r.update(issue), write=True)
+
+    async def update_many(self, changes, issue_ids=(), where=None):
+        return await self.run(lambda r: r.update_many(changes, issue_ids, where), write=True)
+
+    async def close(self, issue_ids=(), where=None):
+        """Close issues, and return the number closed. See Rabbit.close.
+
+        This closes issues, not the AsyncRabbit; that is shutdown().
+
+        """
+
+        return await self.run(lambda r: r.close(issue_ids, where), write=True)
+
+    async def open(self, issue_ids=(), where=None):
+        return await self.run(lambda r: r.open(issue_ids, where), write=True)
+
+    async def delete(self, issue_ids=(), where=None):
+        return await self.run(lambda r: r.delete(issue_ids, where), write=True)
+
+    async def comment(self, issue_id, comment):
+        return await self.run(lambda r: r.comment(issue_id, comment), write=True)
+
+    async def configure(self, name, value):
+        """Change a repository setting. It applies to connections opened
+        afterwards, and to the writer's straight away."""
+
+        return await self.run(lambda r: r.configure(name, value), write=True)
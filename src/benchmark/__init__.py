@@ -0,0 +1,19 @@
+"""Benchmarks for rabbit.
+
+Run from the src directory:
+
+    python -m benchmark generate --sizes 1000,100000
+    python -m benchmark run --sizes 1000,100000 -o results.json
+    python -m benchmark compare before.json after.json
+    python -m benchmark stress --processes 8
+
+Generated repositories are kept in a work directory and reused, so the same
+repositories can be timed against different commits.
+
+"""
+
+import os
+import sys
+
+# rabbit.py lives next to this package, and isn't installed anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,101 @@
+import getopt
+import json
+import os
+import sys
+
+from benchmark.generate import generate, repository_path
+from benchmark.run import compare, run
+from benchmark.stress import report, stress
+
+
+def usage():
+    print("Usage: python -m benchmark [COMMAND] [OPTION]..." +
+          "\nCommands:" +
+          "\n  generate   Generate repositories, if they don't already exist" +
+          "\n  run        Time rabbit operations and write the results as JSON" +
+          "\n  compare    Compare two results files: compare BEFORE AFTER" +
+          "\n  stress     Run adds, comments and lists from several processes at once" +
+          "\nOptions:" +
+          "\n  -s, --sizes=SIZES              comma separated issue counts, default 1000,100000" +
+          "\n  -d, --dir=DIRECTORY            where generated repositories are kept, default bench-repos" +
+          "\n  -r, --runs=RUNS                times each operation is timed, default 100" +
+          "\n  -o, --output=FILE              write results to FILE rather than standard output" +
+          "\n  -p, --processes=N              stress: number of processes, default 4" +
+          "\n  -n, --operations=N             stress: operations per process, default 500" +
+          "\n  -j, --journal-mode=MODE        stress: journal mode of the repository")
+
+
+def main(argv):
+    try:
+        opts, args = getopt.gnu_getopt(argv[1:], "s:d:r:o:p:n:j:",
+            ["sizes=", "dir=", "runs=", "output=", "processes=", "operations=", "journal-mode="])
+    except getopt.GetoptError as e:
+        print('benchmark:', e)
+        return 1
+
+    if not args or args[0] not in ('generate', 'run', 'compare', 'stress'):
+        usage()
+        return 1
+
+    sizes = [1000, 100000]
+    work_dir = 'bench-repos'
+    runs = 100
+    output = None
+    processes = 4
+    operations = 500
+    journal_mode = None
+
+    for opt, arg in opts:
+        if opt in ('-s', '--sizes'):
+            sizes = [int(size) for size in arg.split(',')]
+        if opt in ('-d', '--dir'):
+            work_dir = arg
+        if opt in ('-r', '--runs'):
+            runs = int(arg)
+        if opt in ('-o', '--output'):
+            output = arg
+        if opt in ('-p', '--processes'):
+            processes = int(arg)
+        if opt in ('-n', '--operations'):
+            operations = int(arg)
+        if opt in ('-j', '--journal-mode'):
+            journal_mode = arg
+
+    if args[0] == 'generate':
+        for size in sizes:
+            generate(repository_path(work_dir, size), size)
+
+    elif args[0] == 'stress':
+        results = stress(os.path.join(work_dir, 'stress'), processes, operations, journal_mode=journal_mode)
+
+        if output:
+            with open(output, 'w') as out:
+                out.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+        print('\n'.join(report(results)))
+
+        if results['failed'] or results['lost_adds'] or results['lost_comments']:
+            return 1
+
+    elif args[0] == 'run':
+        results = json.dumps(run(sizes, work_dir, runs), indent=2, sort_keys=True)
+
+        if output:
+            with open(output, 'w') as out:
+                out.write(results + '\n')
+        else:
+            print(results)
+
+    else:
+        if len(args) != 3:
+            usage()
+            return 1
+
+        with open(args[1]) as before, open(args[2]) as after:
+            print('\n'.join(compare(json.load(before), json.load(after))))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
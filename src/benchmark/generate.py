@@ -0,0 +1,107 @@
+"""Generate synthetic rabbit repositories of a given size."""
+
+import contextlib
+import datetime
+import io
+import os
+import random
+import shutil
+
+import rabbit
+
+_statuses = (('closed', 60), ('open', 30), ('reviewing', 7), ('wontfix', 3))
+_types = (('bug', 50), ('enhancement', 30), ('unknown', 15), ('idea', 5))
+_priorities = (('medium', 60), ('low', 25), ('high', 15))
+
+_words = ('segfault', 'crash', 'parser', 'window', 'list', 'search', 'slow',
+          'comment', 'issue', 'option', 'terminal', 'unicode', 'repository',
+          'database', 'locked', 'startup', 'import', 'export', 'filter',
+          'status', 'priority', 'missing', 'broken', 'display', 'update')
+
+
+@contextlib.contextmanager
+def in_directory(path):
+    """Run the block with path as the working directory.
+
+    Rabbit always opens the repository in the working directory.
+
+    """
+
+    previous = os.getcwd()
+    os.chdir(path)
+
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def repository_path(work_dir, size, seed=0):
+    """Return the directory a generated repository of size issues lives in."""
+
+    return os.path.join(work_dir, 'repo-{}-{}'.format(size, seed))
+
+
+def _weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(_words) for i in range(words))
+
+
+def _comment_count(rng, mean):
+    # pareto distributed, so most issues have no comments and a few have
+    # hundreds, like a real tracker
+    return min(int((rng.paretovariate(1.5) - 1) * mean / 2), 500)
+
+
+def issues(size, seed=0, mean_comments=2):
+    """Generate size random Issues, with comments.
+
+    The same seed always generates the same issues.
+
+    """
+
+    rng = random.Random(seed)
+    today = datetime.date(2020, 1, 1)
+
+    for n in range(size):
+        date = today - datetime.timedelta(days=rng.randrange(5 * 365))
+
+        i = rabbit.Issue(type=_weighted(rng, _types), status=_weighted(rng, _statuses),
+            priority=_weighted(rng, _priorities), summary=_text(rng, rng.randint(3, 12)),
+            date=date.isoformat(), description=_text(rng, rng.randint(0, 80)))
+
+        i.comments = [_text(rng, rng.randint(3, 40)) for c in range(_comment_count(rng, mean_comments))]
+
+        yield i
+
+
+def generate(path, size, seed=0, mean_comments=2):
+    """Create a repository of size issues in the directory path.
+
+    Does nothing if the repository already exists. The repository is built
+    in a temporary directory first, so an interrupted run never leaves a
+    partial repository behind to be reused.
+
+    """
+
+    if os.path.isfile(os.path.join(path, rabbit._filename)):
+        return
+
+    partial = path + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+
+    with in_directory(partial):
+        with contextlib.redirect_stdout(io.StringIO()):
+            rabbit.Rabbit.init()
+
+        r = rabbit.Rabbit()
+        r.add_many(issues(size, seed, mean_comments))
+        r.conn.close()
+        r.conn = None
+
+    os.rename(partial, path)
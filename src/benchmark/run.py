@@ -0,0 +1,147 @@
+"""Time rabbit operations against generated repositories."""
+
+import contextlib
+import io
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+import rabbit
+
+from benchmark.generate import generate, in_directory, repository_path
+
+# the launcher, as installed, rather than rabbit.py
+_rabbit_script = os.path.join(os.path.dirname(os.path.abspath(rabbit.__file__)), 'rabbit')
+
+
+def _time(operation, runs):
+    """Run operation runs times and return a dict of timing statistics, in seconds."""
+
+    timings = []
+
+    for run in range(runs):
+        start = time.perf_counter()
+        operation(run)
+        timings.append(time.perf_counter() - start)
+
+    return {'runs': runs, 'min': min(timings), 'median': statistics.median(timings),
+            'max': max(timings)}
+
+
+def _quietly(operation):
+    def run(n):
+        with contextlib.redirect_stdout(io.StringIO()):
+            operation(n)
+
+    return run
+
+
+def benchmarks(r, size, rng, runs):
+    """Return a dict of benchmark name to timing statistics, for one repository.
+
+    Keyword arguments:
+    r -- Rabbit object for the repository, opened in the working directory
+    size -- number of issues the repository was generated with
+    rng -- random.Random used to pick issues
+    runs -- number of times each operation is timed
+
+    """
+
+    ids = [rng.randint(1, size) for i in range(runs)]
+
+    # list and detail go through the command line handling, and render
+    # their output, as they do for users
+    command = lambda *argv: _quietly(lambda n: rabbit.main(['rabbit'] + [
+        a.format(ids[n]) for a in argv], r, 120))
+
+    results = {}
+
+    results['add'] = _time(lambda n: r.add(rabbit.Issue(summary='benchmark issue {}'.format(n))), runs)
+    results['list'] = _time(command('list'), max(1, runs // 10))
+    results['list_first_page'] = _time(command('list', '--limit', '50'), runs)
+    results['list_filtered'] = _time(command('list', 'open'), max(1, runs // 10))
+    results['detail'] = _time(command('detail', '{}'), runs)
+    results['close'] = _time(lambda n: r.close([ids[n]]), runs)
+    results['comment'] = _time(lambda n: r.comment(ids[n], 'benchmark comment {}'.format(n)), runs)
+
+    results['cold_start'] = _time(lambda n: subprocess.run(
+        [sys.executable, _rabbit_script, 'detail', str(ids[n])],
+        stdout=subprocess.DEVNULL, check=True), max(1, runs // 10))
+
+    return results
+
+
+def run(sizes, work_dir, runs=100, seed=0):
+    """Generate any missing repositories, time each one and return the results.
+
+    Each size is timed against a fresh copy of its generated repository, so
+    the mutating benchmarks never change the repository that later runs, or
+    other commits, are timed against.
+
+    """
+
+    results = {
+        'commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'runs': runs,
+        'seed': seed,
+        'sizes': {},
+    }
+
+    for size in sizes:
+        path = repository_path(work_dir, size, seed)
+        generate(path, size, seed)
+
+        scratch = path + '.scratch'
+        shutil.rmtree(scratch, ignore_errors=True)
+        shutil.copytree(path, scratch)
+
+        try:
+            with in_directory(scratch):
+                start = time.perf_counter()
+                r = rabbit.Rabbit()
+                opened = time.perf_counter() - start
+
+                results['sizes'][str(size)] = benchmarks(r, size, random.Random(seed), runs)
+                results['sizes'][str(size)]['open'] = {'runs': 1, 'min': opened,
+                    'median': opened, 'max': opened}
+
+                r.conn.close()
+                r.conn = None
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    return results
+
+
+def compare(before, after):
+    """Return lines comparing the median timings of two sets of results."""
+
+    lines = ['{:>8} {:<16} {:>12} {:>12} {:>8}'.format('size', 'benchmark', 'before ms', 'after ms', 'change')]
+
+    for size in sorted(set(before['sizes']) & set(after['sizes']), key=int):
+        old = before['sizes'][size]
+        new = after['sizes'][size]
+
+        for name in sorted(set(old) & set(new)):
+            a = old[name]['median'] * 1000
+            b = new[name]['median'] * 1000
+            change = '{:+.0%}'.format(b / a - 1) if a else 'n/a'
+
+            lines.append('{:>8} {:<16} {:>12.3f} {:>12.3f} {:>8}'.format(size, name, a, b, change))
+
+    return lines
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(_rabbit_script),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,162 @@
+"""Hammer one repository from several processes at once, and check nothing was lost."""
+
+import collections
+import contextlib
+import io
+import multiprocessing
+import os
+import random
+import shutil
+import time
+
+import rabbit
+
+from benchmark.generate import in_directory
+
+_operations = (('add', 30), ('comment', 30), ('list', 30), ('detail', 10))
+
+
+def _worker(path, worker, operations, seed):
+    """Run operations random operations against the repository in path.
+
+    Returns a dict of what was done: completed and failed counts for each
+    operation, the first few error messages, and every add and comment that
+    was reported as committed, so they can be checked for afterwards.
+
+    """
+
+    rng = random.Random(seed * 1000 + worker)
+    names, weights = zip(*_operations)
+
+    r = rabbit.Rabbit(path)
+
+    completed = collections.Counter()
+    failed = collections.Counter()
+    errors = []
+    added = {}
+    comments = collections.Counter()
+
+    for n in range(operations):
+        operation = rng.choices(names, weights)[0]
+
+        # comment on, and look at, this worker's own issues, so the counts
+        # can be checked exactly
+        if operation in ('comment', 'detail') and not added:
+            operation = 'add'
+
+        try:
+            if operation == 'add':
+                summary = 'stress {} {}'.format(worker, n)
+                added[r.add(rabbit.Issue(summary=summary))] = summary
+            elif operation == 'comment':
+                i_id = rng.choice(list(added))
+                r.comment(i_id, 'stress comment {} {}'.format(worker, n))
+                comments[i_id] += 1
+            elif operation == 'list':
+                list(r.iter_issues('open sort:-id', limit=50))
+            else:
+                r.issue(rng.choice(list(added)))
+
+            completed[operation] += 1
+        except Exception as e:
+            failed[operation] += 1
+
+            if len(errors) < 5:
+                errors.append('{}: {}: {}'.format(operation, type(e).__name__, e))
+
+    r.conn.close()
+    r.conn = None
+
+    return {'completed': completed, 'failed': failed, 'errors': errors,
+            'added': added, 'comments': comments}
+
+
+def _run_worker(args):
+    return _worker(*args)
+
+
+def stress(path, processes=4, operations=500, seed=0, journal_mode=None):
+    """Create a repository in path, run processes workers against it at the
+    same time, and return a report of throughput and lost or failed operations.
+
+    Any repository already in path is replaced.
+
+    Keyword arguments:
+    path -- directory for the repository
+    processes -- number of worker processes
+    operations -- operations run by each worker
+    seed -- seed for the choice of operations
+    journal_mode -- journal_mode setting for the repository, or None for the default
+
+    """
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    with in_directory(path):
+        with contextlib.redirect_stdout(io.StringIO()):
+            rabbit.Rabbit.init()
+
+    r = rabbit.Rabbit(path)
+
+    if journal_mode:
+        r.configure('journal_mode', journal_mode)
+
+    with multiprocessing.Pool(processes) as pool:
+        start = time.perf_counter()
+        results = pool.map(_run_worker, [(path, w, operations, seed) for w in range(processes)])
+        elapsed = time.perf_counter() - start
+
+    completed = collections.Counter()
+    failed = collections.Counter()
+    errors = []
+
+    for result in results:
+        completed.update(result['completed'])
+        failed.update(result['failed'])
+        errors.extend(result['errors'])
+
+    # every add and comment reported as committed must be in the repository
+    stored = dict(r.conn.execute('select id, summary from Issue'))
+    stored_comments = dict(r.conn.execute('select issueID, count(*) from Comment group by issueID'))
+
+    lost_adds = sum(1 for result in results for i_id, summary in result['added'].items()
+                    if stored.get(i_id) != summary)
+    lost_comments = sum(max(0, count - stored_comments.get(i_id, 0))
+                        for result in results for i_id, count in result['comments'].items())
+
+    r.conn.close()
+    r.conn = None
+
+    return {
+        'processes': processes,
+        'operations': processes * operations,
+        'journal_mode': journal_mode or rabbit._settings['journal_mode'][0],
+        'seconds': elapsed,
+        'throughput': sum(completed.values()) / elapsed,
+        'completed': dict(completed),
+        'failed': dict(failed),
+        'lost_adds': lost_adds,
+        'lost_comments': lost_comments,
+        'errors': errors,
+    }
+
+
+def report(results):
+    """Return lines describing the results of stress()."""
+
+    lines = ['{} processes, {} operations, journal_mode {}, {:.2f}s, {:.0f} operations/s'.format(
+        results['processes'], results['operations'], results['journal_mode'],
+        results['seconds'], results['throughput'])]
+
+    lines.append('{:<10} {:>10} {:>8} {:>12}'.format('operation', 'completed', 'failed', 'per second'))
+
+    for name, weight in _operations:
+        done = results['completed'].get(name, 0)
+        lines.append('{:<10} {:>10} {:>8} {:>12.0f}'.format(name, done,
+            results['failed'].get(name, 0), done / results['seconds']))
+
+    lines.append('lost adds: {}, lost comments: {}'.format(results['lost_adds'], results['lost_comments']))
+    lines.extend('error: ' + e for e in results['errors'])
+
+    return lines
@@ -1,8 +1,294 @@
 #!/usr/bin/env python3
 import time
+
+# when rabbit started being imported, for the --trace timing breakdown
+_import_started = time.perf_counter()
+
 import os
 import sqlite3
+import contextlib
+import collections
+import zlib
+import itertools
+
+# modules only some commands need, e.g. json and socket, are imported where
+# they are used, so commands run from hooks and editors start quickly. See
+# rabbit --timing.
 _filename = '.rabbit'
+_socket_filename = '.rabbit.sock'
+_archive_filename = '.rabbit-archive'
+
+# file listing known repositories, one directory per line, for the
+# --all-repos commands
+_registry_filename = os.environ.get('RABBIT_REGISTRY', os.path.expanduser('~/.rabbit-repos'))
+
+# directory searched from -> repository directory found, see find_repository
+_repository_paths = {}
+
+# Statements that recount the stats summary tables from scratch
+_rebuild_stats = [
+    'delete from IssueCount',
+    'delete from OpenIssueDate',
+    """insert into IssueCount(field, value, count)
+       select 'type', coalesce(type, ''), count(*) from Issue group by 2
+       union all select 'status', coalesce(status, ''), count(*) from Issue group by 2
+       union all select 'priority', coalesce(priority, ''), count(*) from Issue group by 2""",
+    """insert into OpenIssueDate(date, count)
+       select coalesce(date, ''), count(*) from Issue where status = 'open' group by 1""",
+]
+
+# Trigger bodies adding an issue to, and removing one from, the stats
+# summary tables
+_stats_increment = ''.join("""
+            insert into IssueCount(field, value, count) values('{0}', coalesce(new.{0}, ''), 1)
+                on conflict(field, value) do update set count = count + 1;""".format(field)
+    for field in ('type', 'status', 'priority')) + """
+            insert into OpenIssueDate(date, count) select coalesce(new.date, ''), 1 where new.status = 'open'
+                on conflict(date) do update set count = count + 1;"""
+
+_stats_decrement = ''.join("""
+            update IssueCount set count = count - 1 where field = '{0}' and value = coalesce(old.{0}, '');""".format(field)
+    for field in ('type', 'status', 'priority')) + """
+            update OpenIssueDate set count = count - 1 where old.status = 'open' and date = coalesce(old.date, '');
+            delete from IssueCount where count = 0;
+            delete from OpenIssueDate where count = 0;"""
+
+# Columns of the Issue and Comment tables, in the repository and its archive
+_issue_columns = """id INTEGER PRIMARY KEY,
+                    type varchar(500),
+                    date varchar(10),
+                    status varchar(10),
+                    priority varchar(500),
+                    summary varchar(500),
+                    description varchar(500)"""
+
+_comment_columns = """id INTEGER PRIMARY KEY,
+                      issueID INTEGER,
+                      description varchar(500)"""
+
+# Schema migrations, applied in order. The schema version of a repository is
+# the number of migrations that have been applied to it, and is stored in the
+# Schema table. Repositories created before versioning existed have no Schema
+# table, and are treated as version 0.
+_migrations = [
+    # 1: secondary indexes for comment lookups and filtered listings
+    ['create index if not exists CommentIssueIndex on Comment(issueID)',
+     'create index if not exists IssueStatusIndex on Issue(status)',
+     'create index if not exists IssuePriorityIndex on Issue(priority)',
+     'create index if not exists IssueDateIndex on Issue(date)'],
+
+    # 2: full text search over issue summaries, descriptions and comments,
+    # kept in sync with the content tables by triggers
+    ["create virtual table IssueSearch using fts5(summary, description, content='Issue', content_rowid='id')",
+     "create virtual table CommentSearch using fts5(description, content='Comment', content_rowid='id')",
+     """create trigger IssueSearchInsert after insert on Issue begin
+            insert into IssueSearch(rowid, summary, description) values(new.id, new.summary, new.description);
+        end""",
+     """create trigger IssueSearchDelete after delete on Issue begin
+            insert into IssueSearch(IssueSearch, rowid, summary, description) values('delete', old.id, old.summary, old.description);
+        end""",
+     """create trigger IssueSearchUpdate after update of summary, description on Issue begin
+            insert into IssueSearch(IssueSearch, rowid, summary, description) values('delete', old.id, old.summary, old.description);
+            insert into IssueSearch(rowid, summary, description) values(new.id, new.summary, new.description);
+        end""",
+     """create trigger CommentSearchInsert after insert on Comment begin
+            insert into CommentSearch(rowid, description) values(new.id, new.description);
+        end""",
+     """create trigger CommentSearchDelete after delete on Comment begin
+            insert into CommentSearch(CommentSearch, rowid, description) values('delete', old.id, old.description);
+        end""",
+     """create trigger CommentSearchUpdate after update of description on Comment begin
+            insert into CommentSearch(CommentSearch, rowid, description) values('delete', old.id, old.description);
+            insert into CommentSearch(rowid, description) values(new.id, new.description);
+        end""",
+     "insert into IssueSearch(IssueSearch) values('rebuild')",
+     "insert into CommentSearch(CommentSearch) values('rebuild')"],
+
+    # 3: repository level settings, see _settings
+    ['create table Setting(name varchar(100) PRIMARY KEY, value varchar(500))'],
+
+    # 4: summary tables for Rabbit.stats, kept up to date by triggers
+    ['create table IssueCount(field varchar(10), value varchar(500), count INTEGER, PRIMARY KEY(field, value))',
+     'create table OpenIssueDate(date varchar(10) PRIMARY KEY, count INTEGER)',
+     'create trigger IssueCountInsert after insert on Issue begin {} end'.format(_stats_increment),
+     'create trigger IssueCountDelete after delete on Issue begin {} end'.format(_stats_decrement),
+     'create trigger IssueCountUpdate after update of type, status, priority, date on Issue begin {} {} end'.format(
+         _stats_decrement, _stats_increment)] + _rebuild_stats,
+
+    # 5: change log, a row for every issue added, changed, commented on or
+    # removed, numbered in order, for Rabbit.changes
+    ['create table Change(version INTEGER PRIMARY KEY AUTOINCREMENT, issueID INTEGER, action varchar(10), date varchar(19))',
+     """create trigger ChangeIssueInsert after insert on Issue begin
+            insert into Change(issueID, action, date) values(new.id, 'add', datetime('now'));
+        end""",
+     """create trigger ChangeIssueDelete after delete on Issue begin
+            insert into Change(issueID, action, date) values(old.id, 'delete', datetime('now'));
+        end""",
+     """create trigger ChangeIssueUpdate after update on Issue
+        when new.type is not old.type or new.date is not old.date or new.status is not old.status
+          or new.priority is not old.priority or new.summary is not old.summary
+          or new.description is not old.description begin
+            insert into Change(issueID, action, date) values(new.id,
+                case when new.status is old.status then 'update'
+                     when new.status = 'closed' then 'close'
+                     when new.status = 'open' then 'open'
+                     else 'update' end,
+                datetime('now'));
+        end""",
+     """create trigger ChangeCommentInsert after insert on Comment begin
+            insert into Change(issueID, action, date) values(new.issueID, 'comment', datetime('now'));
+        end"""],
+
+    # 6: the highest id of any issue moved to the archive, so new issues
+    # never reuse archived ids, and an index for finding when issues were
+    # closed
+    ['create table Archive(max_id INTEGER)',
+     'create index ChangeIssueIndex on Change(issueID, action)'],
+
+    # 7: long descriptions and comments may be stored compressed (see
+    # _pack), so the search indexes read them through views that decompress
+    # them, and issues are only reindexed, or logged as changed, when their
+    # text really changes, not when it is compressed
+    ['drop trigger IssueSearchInsert',
+     'drop trigger IssueSearchDelete',
+     'drop trigger IssueSearchUpdate',
+     'drop trigger CommentSearchInsert',
+     'drop trigger CommentSearchDelete',
+     'drop trigger CommentSearchUpdate',
+     'drop trigger ChangeIssueUpdate',
+     'drop table IssueSearch',
+     'drop table CommentSearch',
+     'create view IssueText as select id, summary, rabbit_text(description) as description from Issue',
+     'create view CommentText as select id, rabbit_text(description) as description from Comment',
+     "create virtual table IssueSearch using fts5(summary, description, content='IssueText', content_rowid='id')",
+     "create virtual table CommentSearch using fts5(description, content='CommentText', content_rowid='id')",
+     """create trigger IssueSearchInsert after insert on Issue begin
+            insert into IssueSearch(rowid, summary, description) values(new.id, new.summary, rabbit_text(new.description));
+        end""",
+     """create trigger IssueSearchDelete after delete on Issue begin
+            insert into IssueSearch(IssueSearch, rowid, summary, description) values('delete', old.id, old.summary, rabbit_text(old.description));
+        end""",
+     """create trigger IssueSearchUpdate after update of summary, description on Issue
+        when new.summary is not old.summary or rabbit_text(new.description) is not rabbit_text(old.description) begin
+            insert into IssueSearch(IssueSearch, rowid, summary, description) values('delete', old.id, old.summary, rabbit_text(old.description));
+            insert into IssueSearch(rowid, summary, description) values(new.id, new.summary, rabbit_text(new.description));
+        end""",
+     """create trigger CommentSearchInsert after insert on Comment begin
+            insert into CommentSearch(rowid, description) values(new.id, rabbit_text(new.description));
+        end""",
+     """create trigger CommentSearchDelete after delete on Comment begin
+            insert into CommentSearch(CommentSearch, rowid, description) values('delete', old.id, rabbit_text(old.description));
+        end""",
+     """create trigger CommentSearchUpdate after update of description on Comment
+        when rabbit_text(new.description) is not rabbit_text(old.description) begin
+            insert into CommentSearch(CommentSearch, rowid, description) values('delete', old.id, rabbit_text(old.description));
+            insert into CommentSearch(rowid, description) values(new.id, rabbit_text(new.description));
+        end""",
+     """create trigger ChangeIssueUpdate after update on Issue
+        when new.type is not old.type or new.date is not old.date or new.status is not old.status
+          or new.priority is not old.priority or new.summary is not old.summary
+          or rabbit_text(new.description) is not rabbit_text(old.description) begin
+            insert into Change(issueID, action, date) values(new.id,
+                case when new.status is old.status then 'update'
+                     when new.status = 'closed' then 'close'
+                     when new.status = 'open' then 'open'
+                     else 'update' end,
+                datetime('now'));
+        end""",
+     "insert into IssueSearch(IssueSearch) values('rebuild')",
+     "insert into CommentSearch(CommentSearch) values('rebuild')"],
+
+    # 8: the highest id of any comment moved to the archive, so new
+    # comments never reuse archived ids either
+    ['alter table Archive add column max_comment_id INTEGER'],
+]
+
+# Descriptions and comments longer than this many bytes are stored zlib
+# compressed, as blobs, see _pack
+_compress_threshold = 1024
+
+def _pack(text):
+    """Return text as it is stored: compressed, if it is long and that makes
+    it smaller, otherwise unchanged."""
+
+    if not isinstance(text, str):
+        return text
+
+    data = text.encode('utf-8')
+
+    if len(data) <= _compress_threshold:
+        return text
+
+    packed = zlib.compress(data)
+
+    return packed if len(packed) < len(data) else text
+
+def _unpack(value):
+    """Return the text stored as value by _pack."""
+
+    return zlib.decompress(value).decode('utf-8') if isinstance(value, bytes) else value
+
+def _connect(filename, factory=sqlite3.Connection, uri=False):
+    """Open a repository database, with rabbit's SQL functions: rabbit_text,
+    which is _unpack, and rabbit_pack. The search indexes and triggers need
+    them, so every connection that changes issues must have them."""
+
+    conn = sqlite3.connect(filename, factory=factory, uri=uri)
+    conn.create_function('rabbit_text', 1, _unpack, deterministic=True)
+    conn.create_function('rabbit_pack', 1, _pack, deterministic=True)
+
+    return conn
+
+# The id the next new issue gets: after every issue, including archived ones
+_next_issue_id = """select max(coalesce((select max(id) from Issue), 0),
+                               coalesce((select max(max_id) from Archive), 0)) + 1"""
+
+# The id the next new comment gets, likewise
+_next_comment_id = """select max(coalesce((select max(id) from Comment), 0),
+                                 coalesce((select max(max_comment_id) from Archive), 0)) + 1"""
+
+# Insert triggers that Rabbit.add_many drops while it adds issues, and the
+# statements that do their work afterwards, for every issue and comment with
+# an id from the given ones onwards, in a single statement each. Comments
+# added along with their issue are part of the issue's 'add' change.
+_bulk_insert_triggers = ('IssueSearchInsert', 'CommentSearchInsert', 'ChangeIssueInsert', 'ChangeCommentInsert')
+
+_bulk_index_new = [
+    'insert into IssueSearch(rowid, summary, description) select id, summary, rabbit_text(description) from Issue where id >= :issue',
+    'insert into CommentSearch(rowid, description) select id, rabbit_text(description) from Comment where id >= :comment',
+    "insert into Change(issueID, action, date) select id, 'add', datetime('now') from Issue where id >= :issue order by id",
+]
+
+# Repository level settings, stored in the Setting table and applied each
+# time a repository is opened: name -> (default, allowed values, or a
+# function that checks a value)
+_settings = {
+    'journal_mode': ('wal', ('delete', 'truncate', 'persist', 'wal')),
+    'synchronous': ('full', ('off', 'normal', 'full', 'extra')),
+    'busy_timeout': ('5000', str.isdigit),
+}
+
+def _retry_locked(operation, retries=5, delay=0.05):
+    """Call operation, retrying while the database is locked, and return its result.
+
+    SQLite has already waited for busy_timeout before reporting the database
+    locked. Retrying, with an exponential, jittered backoff, rides out
+    writers that hold the lock for longer, like a big import, rather than
+    failing. Only use it for statements that are safe to repeat after
+    failing with a lock error: begin and commit.
+
+    """
+
+    for attempt in range(retries + 1):
+        try:
+            return operation()
+        except sqlite3.OperationalError as e:
+            if attempt == retries or ('locked' not in str(e) and 'busy' not in str(e)):
+                raise
+
+            import random
+
+            time.sleep(delay * 2 ** attempt * random.uniform(0.5, 1.5))
 
 class MissingSummaryError(Exception):
     'You must provide a summary'
@@ -17,6 +303,16 @@ class MissingRepositoryError(Exception):
         return self.__doc__
 
 
+class NewerRepositoryError(Exception):
+    "This repository is at schema version {0}, but this rabbit only knows up to {1}. Upgrade rabbit to use it."
+
+    def __init__(self, version):
+        self.version = version
+
+    def __str__(self):
+        return self.__doc__.format(self.version, len(_migrations))
+
+
 class MissingArgumentError(Exception):
     'No arguments supplied'
     def __str__(self):
@@ -46,15 +342,267 @@ class NonexistentIssueError(Exception):
         return self.__doc__
 
 
+class InvalidSearchError(Exception):
+    "'{0}' is not a valid search query"
+
+    def __init__(self, query):
+        self.query = query
+
+    def __str__(self):
+        return self.__doc__.format(self.query)
+
+
+class InvalidSettingError(Exception):
+    "'{0}' is not a valid setting. See 'rabbit help config'."
+
+    def __init__(self, setting):
+        self.setting = setting
+
+    def __str__(self):
+        return self.__doc__.format(self.setting)
+
+
+class InvalidQueryError(Exception):
+    "'{0}' is not a valid query term. See 'rabbit help list'."
+
+    def __init__(self, term):
+        self.term = term
+
+    def __str__(self):
+        return self.__doc__.format(self.term)
+
+
+class InvalidDateError(Exception):
+    "'{0}' is not a valid date. Use YYYY-MM-DD, e.g. 2011-07-01"
+
+    def __init__(self, date):
+        self.date = date
+
+    def __str__(self):
+        return self.__doc__.format(self.date)
+
+
+class InvalidCriteriaError(Exception):
+    "'{0}' is not valid criteria. Use FIELD=VALUE[,FIELD=VALUE]..."
+
+    def __init__(self, criteria):
+        self.criteria = criteria
+
+    def __str__(self):
+        return self.__doc__.format(self.criteria)
+
+
+class IllegalFormatError(Exception):
+    "'{0}' is not a supported format. Use jsonl or csv."
+
+    def __init__(self, format):
+        self.format = format
+
+    def __str__(self):
+        return self.__doc__.format(self.format)
+
+
+class InvalidRecordError(Exception):
+    "Line {0} of the import is not a valid issue: {1}"
+
+    def __init__(self, line, reason):
+        self.line = line
+        self.reason = reason
+
+    def __str__(self):
+        return self.__doc__.format(self.line, self.reason)
+
+
+# fields that bulk mutations may match on, and that update_many may change
+_where_fields = ('id', 'type', 'date', 'status', 'priority', 'summary')
+_update_fields = ('type', 'date', 'status', 'priority', 'summary', 'description')
+
+def parse_where(text):
+    """Parse criteria of the form 'status=open,type=wontfix' into a dict.
+
+    Raises InvalidCriteriaError for malformed criteria or unknown fields.
+
+    """
+
+    where = {}
+
+    for criterion in text.split(','):
+        field, sep, value = criterion.partition('=')
+        field = field.strip()
+
+        if not sep or field not in _where_fields:
+            raise InvalidCriteriaError(criterion)
+
+        where[field] = value.strip()
+
+    return where
+
+# fields a query can filter on, and the fields it can sort by
+_query_fields = ('id', 'type', 'date', 'status', 'priority', 'summary')
+_sort_fields = ('id', 'type', 'date', 'status', 'priority', 'summary')
+
+class Query:
+    """A parsed issue query, which compiles to a parameterized select.
+
+    Build one with parse_query().
+
+    """
+
+    def __init__(self):
+        self.conditions = []
+        self.params = []
+        self.sort = 'id'
+        self.descending = False
+        self.limit = None
+
+    def compile(self, after_id=0, page_size=None, include_description=False, table='Issue'):
+        """Return the (query, parameters) selecting a page of matching issues.
+
+        Keyword arguments:
+        after_id -- if not 0, only select issues after the issue with this id, in sort order
+        page_size -- maximum number of issues to select, or None for no limit
+        include_description -- if True, the description column is selected too
+        table -- table, or view, to select from
+
+        """
+
+        columns = 'id, type, status, priority, summary, date'
+
+        if include_description:
+            columns += ', description'
+
+        conditions = list(self.conditions)
+        params = list(self.params)
+        direction = ' desc' if self.descending else ''
+        compare = '<' if self.descending else '>'
+
+        if after_id:
+            if self.sort == 'id':
+                conditions.append('id {} ?'.format(compare))
+                params.append(after_id)
+            else:
+                # keyset on (sort field, id), so issues with equal sort keys
+                # are neither skipped nor repeated between pages
+                conditions.append('({0}, id) {1} ((select {0} from {2} where id = ?), ?)'.format(self.sort, compare, table))
+                params.extend((after_id, after_id))
+
+        sql = 'select {} from {}'.format(columns, table)
+
+        if conditions:
+            sql += ' where ' + ' and '.join(conditions)
+
+        if self.sort == 'id':
+            sql += ' order by id{}'.format(direction)
+        else:
+            sql += ' order by {0}{1}, id{1}'.format(self.sort, direction)
+
+        if page_size is not None:
+            sql += ' limit ?'
+            params.append(page_size)
+
+        return sql, tuple(params)
+
+
+def parse_query(text):
+    """Parse an issue query into a Query.
+
+    A query is a list of space separated terms, all of which must match:
+
+    FIELD:VALUE       FIELD (id, type, date, status, priority or summary) is VALUE.
+                      Several values may be given, separated by commas.
+    -FIELD:VALUE      FIELD is not VALUE
+    since:DATE        issues dated DATE or later, e.g. since:2011-07-01
+    until:DATE        issues dated DATE or earlier
+    sort:FIELD        sort by FIELD, or by -FIELD for descending order
+    limit:N           at most N issues
+    STATUS            shorthand for status:STATUS. 'all' matches everything.
+
+    Values containing spaces are quoted, e.g. type:'bug fix'. text may also
+    be a list of terms already split, e.g. by query_terms.
+
+    Raises InvalidQueryError for unknown or malformed terms.
+
+    """
+
+    import shlex
+
+    query = Query()
+
+    if isinstance(text, list):
+        terms = text
+    else:
+        try:
+            terms = shlex.split(text or '')
+        except ValueError:
+            raise InvalidQueryError(text)
+
+    for term in terms:
+        field, sep, value = term.partition(':')
+        negate = field.startswith('-')
+        field = field.lstrip('-')
+
+        if not sep:
+            if term == 'all':
+                continue
+
+            field, value = 'status', term
+
+        elif field in ('since', 'until') and not negate:
+            query.conditions.append('date {} ?'.format('>=' if field == 'since' else '<='))
+            query.params.append(value)
+            continue
+
+        elif field == 'sort' and not negate:
+            query.descending = value.startswith('-')
+            query.sort = value.lstrip('-')
+
+            if query.sort not in _sort_fields:
+                raise InvalidQueryError(term)
+
+            continue
+
+        elif field == 'limit' and not negate:
+            try:
+                query.limit = int(value)
+            except ValueError:
+                raise InvalidQueryError(term)
+
+            continue
+
+        if field not in _query_fields or not value:
+            raise InvalidQueryError(term)
+
+        values = value.split(',')
+        query.conditions.append('{} {}in ({})'.format(field, 'not ' if negate else '', ', '.join('?' * len(values))))
+        query.params.extend(values)
+
+    return query
+
+def _chunks(iterable, size):
+    """Generate lists of up to size items from iterable."""
+
+    chunk = []
+
+    for item in iterable:
+        chunk.append(item)
+
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
 class Issue:
 
-    def __init__(self, i_id=None, type='unknown', status='open', priority='medium', summary='', date=time.strftime('%Y-%m-%d'), description=''):
+    def __init__(self, i_id=None, type='unknown', status='open', priority='medium', summary='', date=None, description=''):
         self.i_id = i_id
         self.type = type
         self.status = status
         self.priority = priority
         self.summary = summary
-        self.date = date
+        self.date = date or time.strftime('%Y-%m-%d')
         self.description = description
 
         self.comments = []
@@ -62,26 +610,28 @@ class Issue:
     def generate_update(self):
         """Generate the SQL update statement to update this issue
 
-        This does not generate SQL for comments, or persist the object."""
+        Returns a (query, parameters) tuple. This does not generate SQL for
+        comments, or persist the object."""
 
         if self.i_id is None:
             raise NonexistentIssueError()
 
-        return """update Issue set type = '{0}', date='{1}', status='{2}',
-                  priority='{3}', summary='{4}', description='{5}'
-                  where id = {6}""".format(self.type, self.date,
-                  self.status, self.priority, self.summary,
-                  self.description, self.i_id).replace('\n', '')
+        return ("""update Issue set type = ?, date = ?, status = ?,
+                   priority = ?, summary = ?, description = ? where id = ?""",
+                (self.type, self.date, self.status, self.priority,
+                 self.summary, _pack(self.description), self.i_id))
 
     def generate_insert(self):
         """Generate the SQL insert statement to save this issue
 
-        This does not generate the SQL necessary for saving the comments, nor does it actually persist the object."""
+        Returns a (query, parameters) tuple. If the issue has no id, SQLite
+        picks one. This does not generate the SQL necessary for saving the
+        comments, nor does it actually persist the object."""
 
-        return """insert into Issue(type, date, status, priority, summary,
-                  description) values('{0}', '{1}', '{2}', '{3}', '{4}',
-                  '{5}');""".format(self.type, self.date, self.status, self.priority,
-                  self.summary, self.description).replace('\n', '')
+        return ("""insert into Issue(id, type, date, status, priority, summary,
+                   description) values(?, ?, ?, ?, ?, ?, ?)""",
+                (self.i_id, self.type, self.date, self.status, self.priority,
+                 self.summary, _pack(self.description)))
 
     def __str__(self):
         text = 'Issue ID: {}\nSummary: {}\nType: {}\nDate: {}\nStatus: {}\nPriority: {}\nDescription: {}'.format(
@@ -100,205 +650,1693 @@ class Issue:
             text += "<br><br><b>Comments:</b><br>"
             text += "<br><br>".join([c[1] for c in self.comments])
 
-        return text
+        return text
+
+
+class IssueRow:
+    """A compact, read only issue, as shown in issue lists.
+
+    Only the summary columns are held. The description and comments are
+    loaded from the repository the first time they are used, and kept.
+    Use Rabbit.issue() for an Issue that can be changed and saved.
+
+    """
+
+    __slots__ = ('i_id', 'type', 'status', 'priority', 'summary', 'date',
+                 '_rabbit', '_description', '_comments')
+
+    def __init__(self, rabbit, i_id, type, status, priority, summary, date):
+        self._rabbit = rabbit
+        self.i_id = i_id
+        self.type = type
+        self.status = status
+        self.priority = priority
+        self.summary = summary
+        self.date = date
+        self._description = None
+        self._comments = None
+
+    @property
+    def description(self):
+        if self._description is None:
+            r = self._rabbit.conn.execute('select description from Issue where id = ?', (self.i_id,)).fetchone()
+            self._description = _unpack(r[0]) if r else ''
+
+        return self._description
+
+    @property
+    def comments(self):
+        if self._comments is None:
+            self._comments = [(c[0], _unpack(c[1])) for c in self._rabbit.conn.execute(
+                'select id, description from Comment where issueID = ? order by id', (self.i_id,))]
+
+        return self._comments
+
+    __str__ = Issue.__str__
+    __repr__ = Issue.__repr__
+
+
+class Stats:
+    """Counts of the issues in a repository, as returned by Rabbit.stats().
+
+    total -- number of issues
+    status, type, priority -- dicts of each value to the number of issues with it
+    open_age -- list of (age, number of open issues) tuples, youngest first
+
+    """
+
+    def __init__(self, status, type, priority, open_age):
+        self.status = status
+        self.type = type
+        self.priority = priority
+        self.open_age = open_age
+        self.total = sum(status.values())
+
+    def __str__(self):
+        text = 'Issues: {}'.format(self.total)
+
+        for title, counts in (('Status', self.status), ('Type', self.type), ('Priority', self.priority)):
+            text += '\n\n{}:'.format(title)
+
+            for value, count in sorted(counts.items(), key=lambda c: (-c[1], c[0])):
+                text += '\n  {:<16} {:>8}'.format(value or '(none)', count)
+
+        text += '\n\nOpen issues by age:'
+
+        for age, count in self.open_age:
+            text += '\n  {:<16} {:>8}'.format(age, count)
+
+        return text
+
+
+class SearchResult:
+    """A single search hit: the matching issue and a snippet of the matching text."""
+
+    def __init__(self, i_id, summary, snippet, rank):
+        self.i_id = i_id
+        self.summary = summary
+        self.snippet = snippet
+        self.rank = rank
+
+    def __str__(self):
+        return '{}: {}\n    {}'.format(self.i_id, self.summary, self.snippet.replace('\n', ' '))
+
+
+# Rabbit.search's query: the best match, and its snippet, for each issue
+# matching an FTS5 query in its summary, description or comments
+_search_sql = """select id, summary, snippet, min(rank) from (
+                 select i.id as id, i.summary as summary,
+                        snippet(IssueSearch, -1, '[', ']', '...', 12) as snippet,
+                        bm25(IssueSearch) as rank
+                 from IssueSearch join Issue i on i.id = IssueSearch.rowid
+                 where IssueSearch match ?
+                 union all
+                 select i.id, i.summary,
+                        snippet(CommentSearch, 0, '[', ']', '...', 12),
+                        bm25(CommentSearch)
+                 from CommentSearch join Comment c on c.id = CommentSearch.rowid
+                      join Issue i on i.id = c.issueID
+                 where CommentSearch match ?)
+              group by id order by min(rank) limit ?"""
+
+
+class Change:
+    """An entry in the change log, as returned by Rabbit.changes().
+
+    version -- position of the change in the log. Every change has a higher
+               version than the ones before it.
+    i_id -- id of the issue changed
+    action -- add, update, close, open, comment, delete or archive
+    date -- UTC date and time of the change, e.g. 2011-07-01 12:30:00
+
+    """
+
+    def __init__(self, version, i_id, action, date):
+        self.version = version
+        self.i_id = i_id
+        self.action = action
+        self.date = date
+
+    def __str__(self):
+        return '{:>6} {:>6} {:<8} {}'.format(self.version, self.i_id, self.action, self.date)
+
+
+def find_repository(start=None):
+    """Return the directory of the repository that start is in, or None.
+
+    start, and then each of its parents, is checked for a repository, so
+    rabbit can be run from anywhere inside a project. Directories found are
+    remembered for the life of the process.
+
+    Keyword arguments:
+    start -- directory to search from. Defaults to the working directory
+
+    """
+
+    start = os.path.abspath(start or os.getcwd())
+    found = _repository_paths.get(start)
+
+    if found and os.path.isfile(os.path.join(found, _filename)):
+        return found
+
+    directory = start
+
+    while True:
+        if os.path.isfile(os.path.join(directory, _filename)):
+            _repository_paths[start] = directory
+            return directory
+
+        parent = os.path.dirname(directory)
+
+        if parent == directory:
+            return None
+
+        directory = parent
+
+def registered_repositories():
+    """Return the list of known repository directories, in registry order."""
+
+    try:
+        with open(_registry_filename) as registry:
+            return [line.strip() for line in registry if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def register_repository(path):
+    """Add the repository in the directory path to the registry.
+
+    Returns the absolute path registered.
+
+    """
+
+    path = os.path.abspath(path)
+
+    if not os.path.isfile(os.path.join(path, _filename)):
+        raise MissingRepositoryError()
+
+    if path not in registered_repositories():
+        with open(_registry_filename, 'a') as registry:
+            registry.write(path + '\n')
+
+    return path
+
+def unregister_repository(path):
+    """Remove the directory path from the registry, if it is there."""
+
+    path = os.path.abspath(path)
+    remaining = [r for r in registered_repositories() if r != path]
+
+    with open(_registry_filename, 'w') as registry:
+        registry.writelines(r + '\n' for r in remaining)
+
+def federated(operation, paths=None, workers=8):
+    """Run operation against several repositories at once, generating each
+    result as soon as it is ready.
+
+    Each repository is opened on a thread of its own, so operation must
+    return everything the caller needs, e.g. a list rather than a generator.
+    IssueRows are fine as long as only their summary columns are used.
+    Generates (path, result, error) tuples, in the order the repositories
+    finish, where error is the exception raised, if any, and result is None.
+
+    Example:
+        for path, issues, error in federated(lambda r: list(r.iter_issues('open'))):
+            ...
+
+    Keyword arguments:
+    operation -- function taking a Rabbit
+    paths -- repository directories. Defaults to every registered repository
+    workers -- maximum number of repositories queried at the same time
+
+    """
+
+    if paths is None:
+        paths = registered_repositories()
+
+    def run(path):
+        r = Rabbit(path)
+
+        try:
+            return operation(r)
+        finally:
+            # connections can only be closed by the thread that made them
+            r.conn.close()
+            r.conn = None
+
+    if not paths:
+        return
+
+    import concurrent.futures
+
+    with concurrent.futures.ThreadPoolExecutor(min(workers, len(paths))) as pool:
+        futures = dict((pool.submit(run, path), path) for path in paths)
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+def _copy(source, target):
+    """Replace the database on target with a copy of the one on source, with
+    SQLite's backup API."""
+
+    # a copy of a wal database is marked as one, and memdb, which can't do
+    # wal, then refuses to open it, so mark a private copy as an ordinary one
+    if (target.execute('pragma journal_mode').fetchone()[0] == 'memory'
+            and source.execute('pragma journal_mode').fetchone()[0] == 'wal'):
+        data = bytearray(source.serialize())
+        data[18:20] = b'\x01\x01'
+        source = sqlite3.connect(':memory:')
+        source.deserialize(bytes(data))
+
+    source.backup(target)
+
+
+def _create_tables(conn):
+    """Create the tables of a new repository on conn, at the latest schema version."""
+
+    conn.execute('create table Issue({})'.format(_issue_columns))
+    conn.execute('create table Comment({})'.format(_comment_columns))
+    Rabbit.migrate(conn)
+
+
+class FileStorage:
+    """Keeps a repository in a .rabbit file. This is what Rabbit uses unless
+    it is given another storage.
+
+    path -- directory of the repository
+
+    """
+
+    def __init__(self, path=None):
+        """Keyword arguments:
+        path -- directory of the repository. Defaults to the nearest one, from
+                the working directory up
+
+        """
+
+        if path is None:
+            path = find_repository()
+
+        if path is None:
+            raise MissingRepositoryError()
+
+        self.path = path
+        self.filename = os.path.join(path, _filename)
+        self.archive_filename = os.path.join(path, _archive_filename)
+
+    def connect(self, factory=sqlite3.Connection):
+        """Return a new connection to the repository, which must exist."""
+
+        if not os.path.isfile(self.filename):
+            raise MissingRepositoryError()
+
+        return _connect(self.filename, factory)
+
+    def open(self):
+        """Return a new connection for copying into, or out of, the
+        repository, creating its file if needed. See Rabbit.snapshot."""
+
+        return _connect(self.filename)
+
+    def archive(self, create=False):
+        """Return where the archive is, to attach it, or None if there is no
+        archive and create is False."""
+
+        if create or os.path.isfile(self.archive_filename):
+            return self.archive_filename
+
+        return None
+
+
+class MemoryStorage:
+    """Keeps a repository in memory, for tests and throwaway jobs. It starts
+    empty, unless restored into, and is gone once the storage, and every
+    Rabbit using it, are.
+
+    Every Rabbit given the same MemoryStorage shares its repository, with
+    SQLite's usual locking, so they can be used from several threads, e.g. by
+    AsyncRabbit.
+
+    Example:
+        r = Rabbit(storage=MemoryStorage())
+
+    """
+
+    _names = itertools.count()
+
+    def __init__(self):
+        self.path = None
+        self.name = '/rabbit-{}-{}'.format(os.getpid(), next(MemoryStorage._names))
+        self.uri = 'file:{}?vfs=memdb'.format(self.name)
+        self.archive_uri = 'file:{}-archive?vfs=memdb'.format(self.name)
+        self._archive = None
+
+        # an in-memory database lasts only as long as a connection to it
+        self._keeper = _connect(self.uri, uri=True)
+        _create_tables(self._keeper)
+
+    def connect(self, factory=sqlite3.Connection):
+        return _connect(self.uri, factory, uri=True)
+
+    def open(self):
+        return _connect(self.uri, uri=True)
+
+    def archive(self, create=False):
+        if create and self._archive is None:
+            self._archive = _connect(self.archive_uri, uri=True)
+
+        return self.archive_uri if self._archive else None
+
+
+class _TracingCursor(sqlite3.Cursor):
+    """Cursor that reports each statement to its connection's trace hook, once
+    it has finished, with the time spent in SQLite and the rows it returned,
+    or changed."""
+
+    _statement = None
+
+    def execute(self, sql, params=()):
+        self._finish()
+        start = time.perf_counter()
+        super().execute(sql, params)
+        self._statement = [sql, params, time.perf_counter() - start, 0]
+
+        if self.description is None:
+            self._finish()
+
+        return self
+
+    def executemany(self, sql, params):
+        self._finish()
+        start = time.perf_counter()
+        super().executemany(sql, params)
+        self._statement = [sql, (), time.perf_counter() - start, 0]
+        self._finish()
+
+        return self
+
+    def _fetched(self, start, rows, done):
+        if self._statement:
+            self._statement[2] += time.perf_counter() - start
+            self._statement[3] += rows
+
+            if done:
+                self._finish()
+
+    def __next__(self):
+        start = time.perf_counter()
+
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(start, 0, True)
+            raise
+
+        self._fetched(start, 1, False)
+        return row
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, row is not None, row is None)
+
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(size or self.arraysize)
+        self._fetched(start, len(rows), len(rows) < (size or self.arraysize))
+
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows), True)
+
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+    def _finish(self):
+        if self._statement is None:
+            return
+
+        sql, params, seconds, rows = self._statement
+        self._statement = None
+
+        if self.description is None:
+            rows = max(self.rowcount, 0)
+
+        self.connection.trace(sql, params, seconds, rows)
+
+
+class _TracingConnection(sqlite3.Connection):
+    """Connection whose statements, and commits, are reported to trace, a
+    function taking (sql, params, seconds, rows)."""
+
+    trace = None
+
+    def cursor(self, factory=_TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+    def commit(self):
+        start = time.perf_counter()
+        super().commit()
+        self.trace('commit', (), time.perf_counter() - start, 0)
+
+
+class Tracer:
+    """Trace hook for Rabbit that counts and times statements, and writes
+    each one to out, if given.
+
+    Example:
+        tracer = Tracer(sys.stderr)
+        r = Rabbit(trace=tracer)
+        r.issues('open')
+        print(tracer.statements, tracer.seconds)
+
+    """
+
+    def __init__(self, out=None):
+        self.out = out
+        self.statements = 0
+        self.seconds = 0.0
+
+        # for timing(): when tracing started, and the time spent, and the
+        # statements run, opening the repository
+        self.started = time.perf_counter()
+        self.open_seconds = 0.0
+        self.open_statements = 0
+        self.open_query_seconds = 0.0
+
+    def __call__(self, sql, params, seconds, rows):
+        self.statements += 1
+        self.seconds += seconds
+
+        if self.out:
+            print('trace: {:9.3f} ms {:>7} rows  {}{}'.format(seconds * 1000, rows, ' '.join(sql.split()),
+                '  {}'.format(params) if params else ''), file=self.out)
+
+    def opened(self, seconds):
+        """Record that opening the repository took seconds, and that the
+        statements run so far were part of it."""
+
+        self.open_seconds = seconds
+        self.open_statements = self.statements
+        self.open_query_seconds = self.seconds
+
+    def timing(self):
+        """Return a line breaking down the wall-clock time since rabbit was
+        imported into startup, opening the repository, queries, and
+        everything else, which is mostly rendering."""
+
+        now = time.perf_counter()
+        query = self.seconds - self.open_query_seconds
+        render = now - self.started - self.open_seconds - query
+
+        return 'timing: startup {:.1f} ms, open {:.1f} ms, query {:.1f} ms in {} statements, render {:.1f} ms, total {:.1f} ms'.format(
+            (self.started - _import_started) * 1000, self.open_seconds * 1000, query * 1000,
+            self.statements - self.open_statements, render * 1000, (now - _import_started) * 1000)
+
+
+"""Rabbit class, for managing bugs in the rabbit repository"""
+class Rabbit:
+    conn = None
+    _transaction_depth = 0
+
+    # number of issues Rabbit.issue() keeps loaded
+    cache_size = 256
+
+    # times taking the write lock is retried when the database stays locked,
+    # and the delay, in seconds, before the first retry. See transaction()
+    write_retries = 5
+    retry_delay = 0.05
+
+    def __init__(self, path=None, trace=None, storage=None):
+        """Create the Rabbit object.
+
+        Will raise MissingRepositoryError if you haven't initialised a
+        repository in the working directory, or any directory above it
+
+        Keyword arguments:
+        path -- directory of the repository to open, rather than searching
+                for one with find_repository
+        storage -- where the repository is kept, e.g. MemoryStorage(), rather
+                   than in a file. path is ignored if this is given
+        trace -- function called with (sql, params, seconds, rows) after each
+                 statement finishes, with the time spent in SQLite and the
+                 rows returned or changed, e.g. a Tracer. Commits are
+                 reported as 'commit'. Tracing slows every query a little,
+                 so it is off unless given.
+
+        """
+
+        if storage is None:
+            storage = FileStorage(path)
+
+        self.storage = storage
+        self.path = storage.path
+        if trace:
+            self.conn = storage.connect(_TracingConnection)
+            self.conn.trace = trace
+        else:
+            self.conn = storage.connect()
+        Rabbit.migrate(self.conn)
+
+        # issue id to (issue row, comments), least recently used first
+        self._cache = collections.OrderedDict()
+        self._data_version = None
+
+        # the busy timeout first, so it covers switching journal modes
+        for name, value in sorted(self.settings().items(), key=lambda setting: setting[0] != 'busy_timeout'):
+            self._apply_setting(name, value)
+
+    def __del__(self):
+        if self.conn:
+            self.conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group several changes into a single transaction.
+
+        Every mutating method commits on its own, unless it is called inside
+        this block, in which case nothing is committed until the block exits.
+        If the block raises, every change made inside it is rolled back.
+        Nested blocks join the outermost one.
+
+        The write lock is taken when the block starts. If another process
+        holds it for longer than the busy_timeout setting, taking it, and
+        committing, are retried up to write_retries times, with exponential
+        backoff. If committing still fails, the changes are rolled back.
+
+        Example:
+            with rabbit.transaction():
+                rabbit.add(issue)
+                rabbit.close([1, 2, 3])
+
+        """
+
+        if self._transaction_depth == 0:
+            _retry_locked(lambda: self.conn.execute('begin immediate'), self.write_retries, self.retry_delay)
+
+        self._transaction_depth += 1
+
+        try:
+            yield self
+        except:
+            self._transaction_depth -= 1
+
+            if self._transaction_depth == 0:
+                self.conn.rollback()
+
+                # issues loaded inside the block may hold rolled back changes
+                self._cache.clear()
+
+            raise
+
+        self._transaction_depth -= 1
+
+        if self._transaction_depth == 0:
+            try:
+                # a commit that fails because the database is locked leaves
+                # the transaction open, and can be tried again
+                _retry_locked(self.conn.commit, self.write_retries, self.retry_delay)
+            except:
+                self.conn.rollback()
+                self._cache.clear()
+                raise
+
+    def settings(self):
+        """Return a dict of every repository setting and its current value."""
+
+        settings = dict((name, default) for name, (default, allowed) in _settings.items())
+        settings.update(self.conn.execute('select name, value from Setting'))
+
+        return settings
+
+    def configure(self, name, value):
+        """Change a repository setting, and apply it to this connection.
+
+        Settings are stored in the repository, and applied every time it is
+        opened. They are:
+
+        journal_mode -- SQLite journal mode: delete, truncate, persist or wal.
+                        wal, the default, lets readers and a writer work at
+                        the same time, and makes commits cheaper. Use delete
+                        for repositories on network filesystems.
+        synchronous -- how hard SQLite works to make commits durable: off,
+                       normal, full or extra. normal is safe with wal, and
+                       skips most fsyncs.
+        busy_timeout -- milliseconds to wait for another process to finish
+                        with the database before reporting it locked
+
+        Keyword arguments:
+        name -- name of the setting
+        value -- new value of the setting
+
+        """
+
+        value = value.lower()
+
+        if name not in _settings:
+            raise InvalidSettingError(name)
+
+        allowed = _settings[name][1]
+
+        if not (allowed(value) if callable(allowed) else value in allowed):
+            raise InvalidSettingError('{}={}'.format(name, value))
+
+        with self.transaction():
+            self.conn.execute('insert or replace into Setting(name, value) values(?, ?)', (name, value))
+
+        self._apply_setting(name, value)
+
+    def _apply_setting(self, name, value):
+        # values are checked against _settings, so formatting them is safe
+        self.conn.execute('pragma {} = {}'.format(name, value))
+
+    @staticmethod
+    def init():
+        """Create the database file and create the tables."""
+
+        if os.path.isfile(_filename):
+            raise RepositoryExistsError()
+
+        conn = _connect(_filename)
+        _create_tables(conn)
+        conn.close()
+        print('Empty Rabbit repository created')
+
+    @staticmethod
+    def schema_version(conn):
+        """Return the schema version of the repository open on conn."""
+
+        exists = conn.execute("select 1 from sqlite_master where type = 'table' and name = 'Schema'").fetchone()
+
+        if exists is None:
+            return 0
+
+        return conn.execute('select version from Schema').fetchone()[0]
+
+    @staticmethod
+    def migrate(conn):
+        """Bring the repository open on conn up to the latest schema version.
+
+        Each pending migration is applied in order, inside a single
+        transaction, so a repository is never left half upgraded. Raises
+        NewerRepositoryError, and changes nothing, if the repository was
+        upgraded by a newer rabbit.
+
+        Keyword arguments:
+        conn -- sqlite3 connection to the repository
+
+        """
+
+        version = Rabbit.schema_version(conn)
+
+        if version > len(_migrations):
+            raise NewerRepositoryError(version)
+
+        if version == len(_migrations):
+            return
+
+        _retry_locked(lambda: conn.execute('begin immediate'))
+
+        try:
+            # another process may have migrated while we waited for the lock
+            version = Rabbit.schema_version(conn)
+
+            if version > len(_migrations):
+                raise NewerRepositoryError(version)
+
+            if version == 0:
+                conn.execute('create table if not exists Schema(version INTEGER)')
+                conn.execute('insert into Schema(version) values(0)')
+
+            for statements in _migrations[version:]:
+                for statement in statements:
+                    conn.execute(statement)
+
+            conn.execute('update Schema set version = ?', (len(_migrations),))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+    def add(self, issue):
+        """Add a new issue to the repository
+
+        Returns the id of the new issue, which is also set on issue.
+
+        Keyword arguments:
+        issue -- Issue object to be stored
+
+        """
+
+        if not issue.summary:
+            raise MissingSummaryError()
+
+        sql, params = issue.generate_insert()
+
+        with self.transaction():
+            if issue.i_id is None:
+                # not left to SQLite, which would reuse archived issues' ids
+                params = (self.conn.execute(_next_issue_id).fetchone()[0],) + params[1:]
+
+            issue.i_id = self.conn.execute(sql, params).lastrowid
+
+        return issue.i_id
+
+    def add_many(self, issues, chunk_size=1000):
+        """Add many issues, and their comments, in a single transaction.
+
+        Issues are numbered after the highest existing id, archived issues
+        included, ignoring any id they already carry, and are written with
+        executemany a chunk at a time, so issues may be any iterable,
+        including a generator reading from a file. If any issue is invalid,
+        nothing is added.
+
+        Returns the number of issues added.
+
+        Keyword arguments:
+        issues -- iterable of Issue objects. Their comments may be strings or
+                  (id, text) tuples.
+        chunk_size -- number of issues held in memory at a time
+
+        """
+
+        insert_issue = Issue().generate_insert()[0]
+        insert_comment = 'insert into Comment(id, issueID, description) values(?, ?, ?)'
+
+        with self.transaction():
+            next_id = self.conn.execute(_next_issue_id).fetchone()[0]
+            first_comment_id = self.conn.execute(_next_comment_id).fetchone()[0]
+            next_comment_id = first_comment_id
+            count = 0
+
+            # indexing rows for search, and logging them, one at a time from
+            # triggers costs far more than doing them all in one statement
+            # at the end
+            triggers = self.conn.execute("""select name, sql from sqlite_master where type = 'trigger'
+                                            and name in ({})""".format(', '.join('?' * len(_bulk_insert_triggers))),
+                                         _bulk_insert_triggers).fetchall()
+
+            for name, sql in triggers:
+                self.conn.execute('drop trigger {}'.format(name))
+
+            for chunk in _chunks(issues, chunk_size):
+                issue_rows = []
+                comment_rows = []
+
+                for issue in chunk:
+                    if not issue.summary:
+                        raise MissingSummaryError()
+
+                    issue_rows.append((next_id, issue.type, issue.date, issue.status,
+                        issue.priority, issue.summary, _pack(issue.description)))
+
+                    for c in issue.comments:
+                        comment_rows.append((next_comment_id, next_id, _pack(c[1] if isinstance(c, tuple) else c)))
+                        next_comment_id += 1
+
+                    next_id += 1
+
+                self.conn.executemany(insert_issue, issue_rows)
+                self.conn.executemany(insert_comment, comment_rows)
+                count += len(issue_rows)
+
+            first_id = next_id - count
+
+            for statement in _bulk_index_new:
+                self.conn.execute(statement, {'issue': first_id, 'comment': first_comment_id})
+
+            for name, sql in triggers:
+                self.conn.execute(sql)
+
+        return count
+
+    def dump(self, status_filter='all'):
+        """Generate every Issue in the repository, with its comments, in id order.
+
+        Keyword arguments:
+        status_filter -- status, or query for parse_query, to filter. Pass all to dump everything
+
+        """
+
+        return self.iter_issues(status_filter, include_comments=True)
+
+    def _mutate(self, statement, issue_ids=(), where=None, params=()):
+        """Run statement against the matching issues and return the rows affected.
+
+        statement must contain a '{}' where the where clause belongs. With
+        issue_ids, it is run with a single executemany call, once per id,
+        otherwise as a single statement. Nothing is committed.
+
+        Keyword arguments:
+        statement -- SQL statement, e.g. "delete from Issue{}"
+        issue_ids -- iterable of issue ids to match
+        where -- dict of field name to value an issue must have to match
+        params -- parameters for the statement itself, before the where clause
+
+        """
+
+        clauses = ['id = ?'] if issue_ids else []
+        where_params = []
+
+        for field, value in sorted((where or {}).items()):
+            if field not in _where_fields:
+                raise InvalidCriteriaError(field)
+
+            clauses.append('{} = ?'.format(field))
+            where_params.append(value)
+
+        if not clauses:
+            raise MissingArgumentError()
+
+        statement = statement.format(' where ' + ' and '.join(clauses))
+
+        if issue_ids:
+            rows = [tuple(params) + (i_id,) + tuple(where_params) for i_id in issue_ids]
+            return self.conn.executemany(statement, rows).rowcount
+
+        return self.conn.execute(statement, tuple(params) + tuple(where_params)).rowcount
+
+    def close(self, issue_ids=(), where=None):
+        """Update the status of issues to 'closed'
+
+        Returns the number of issues closed.
+
+        Keyword arguments:
+        issue_ids -- iterable of integer ids to be closed
+        where -- dict of field name to value, e.g. {'type': 'wontfix'}. If
+                 given, only issues matching all of them are closed.
+
+        """
+
+        # may be a generator, and is read more than once below
+        issue_ids = list(issue_ids)
+
+        with self.transaction():
+            self._invalidate(issue_ids, where)
+            count = self._mutate("update Issue set status = 'closed'{}", issue_ids, where)
+
+        return count
+
+    def open(self, issue_ids=(), where=None):
+        """Update the status of issues to 'open'
+
+        Returns the number of issues opened.
+
+        Keyword arguments:
+        issue_ids -- iterable of integer ids to be opened
+        where -- dict of field name to value. If given, only issues matching
+                 all of them are opened.
+
+        """
+
+        issue_ids = list(issue_ids)
+
+        with self.transaction():
+            self._invalidate(issue_ids, where)
+            count = self._mutate("update Issue set status = 'open'{}", issue_ids, where)
+
+        return count
+
+    def update(self, issue):
+        """Update an issue in the database
+
+        Keyword arguments:
+        issue -- Issue object to be updated in the database
+
+        """
+
+        if not issue.summary:
+            raise MissingSummaryError()
+
+        with self.transaction():
+            self._invalidate([issue.i_id])
+            self.conn.execute(*issue.generate_update())
+
+    def update_many(self, changes, issue_ids=(), where=None):
+        """Set the same fields on many issues at once.
+
+        Returns the number of issues updated.
+
+        Keyword arguments:
+        changes -- dict of field name to new value, e.g. {'priority': 'low'}
+        issue_ids -- iterable of integer ids to be updated
+        where -- dict of field name to value. If given, only issues matching
+                 all of them are updated.
+
+        """
+
+        if not changes:
+            raise MissingArgumentError()
+
+        for field in changes:
+            if field not in _update_fields:
+                raise InvalidCriteriaError(field)
+
+        if changes.get('summary') == '':
+            raise MissingSummaryError()
+
+        fields = sorted(changes)
+        statement = 'update Issue set ' + ', '.join('{} = ?'.format(f) for f in fields) + '{}'
+
+        issue_ids = list(issue_ids)
+
+        with self.transaction():
+            self._invalidate(issue_ids, where)
+            count = self._mutate(statement, issue_ids, where, [_pack(changes[f]) if f == 'description' else changes[f]
+                                                               for f in fields])
+
+        return count
+
+    def delete(self, issue_ids=(), where=None):
+        """Delete issues and all associated comments.
+
+        Returns the number of issues deleted.
+
+        Keyword arguments:
+        issue_ids -- iterable of integer ids of the Issues to be removed.
+        where -- dict of field name to value. If given, only issues matching
+                 all of them are removed.
+
+        """
+
+        issue_ids = list(issue_ids)
+
+        with self.transaction():
+            self._invalidate(issue_ids, where)
+            self._mutate('delete from Comment where issueID in (select id from Issue{})', issue_ids, where)
+            count = self._mutate('delete from Issue{}', issue_ids, where)
+
+        return count
+
+    def comment(self, issue_id, comment):
+        """Add a comment to an issue
+
+        Keyword arguments:
+        issue_id -- issue id to add a comment to
+        comment -- string containing the comment.
+
+        """
+
+        with self.transaction():
+            self._invalidate([issue_id])
+            # not left to SQLite, which would reuse archived comments' ids
+            self.conn.execute('insert into Comment(id, issueID, description) values(?, ?, ?)',
+                              (self.conn.execute(_next_comment_id).fetchone()[0], issue_id, _pack(comment)))
+
+    def issue(self, issue_id, include_archived=False):
+        """Return a specific Issue, with its comments
+
+        Recently returned issues are kept, up to cache_size of them, and
+        returned again without touching the tables, until they are changed.
+        Changes made through this Rabbit drop just the issues they touch.
+        Changes made by anyone else drop them all, the next time one is
+        asked for. Each call returns a new Issue, so it can be changed
+        freely.
+
+        Keyword arguments:
+        issue_id -- id of the issue to return
+        include_archived -- if True, look in the archive as well, see archive()
+
+        """
+
+        issue_id = int(issue_id)
+
+        self._check_cache()
+
+        if issue_id not in self._cache:
+            self._load([issue_id])
+
+        if issue_id not in self._cache:
+            if include_archived and self._attach_archive():
+                return self._archived_issue(issue_id)
+
+            raise NonexistentIssueError()
+
+        self._cache.move_to_end(issue_id)
+        r, comments = self._cache[issue_id]
+
+        i = Issue(r[0], r[1], r[2], r[3], r[4], r[5], r[6])
+        i.comments = list(comments)
+
+        return i
+
+    def prefetch(self, issue_ids):
+        """Load issues that are likely to be asked for soon, like the ones next
+        to the issue being shown, so Rabbit.issue() has them ready.
+
+        Issues that are already loaded, or don't exist, are skipped.
+
+        Keyword arguments:
+        issue_ids -- iterable of issue ids
+
+        """
+
+        self._check_cache()
+        self._load([int(i_id) for i_id in issue_ids if int(i_id) not in self._cache])
+
+    def _load(self, issue_ids):
+        """Read issues and their comments into the cache, two queries in all."""
+
+        issue_ids = issue_ids[-self.cache_size:]
+
+        if not issue_ids:
+            return
+
+        ids = ', '.join('?' * len(issue_ids))
+        loaded = {}
+
+        for r in self.conn.execute("""select id, type, status, priority, summary, date, description
+                                      from Issue where id in ({})""".format(ids), issue_ids):
+            loaded[r[0]] = (r[:6] + (_unpack(r[6]),), [])
+
+        for c in self.conn.execute("""select id, issueID, description from Comment
+                                      where issueID in ({}) order by id""".format(ids), issue_ids):
+            loaded[c[1]][1].append((c[0], _unpack(c[2])))
+
+        for i_id in issue_ids:
+            if i_id in loaded:
+                self._cache[i_id] = (loaded[i_id][0], tuple(loaded[i_id][1]))
+
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _archived_issue(self, issue_id):
+        r = self.conn.execute("""select id, type, status, priority, summary, date, description
+                                 from archive.Issue where id = ?""", (issue_id,)).fetchone()
+
+        if r is None:
+            raise NonexistentIssueError()
+
+        i = Issue(r[0], r[1], r[2], r[3], r[4], r[5], _unpack(r[6]))
+        i.comments = [(c[0], _unpack(c[1])) for c in self.conn.execute(
+            'select id, description from archive.Comment where issueID = ? order by id', (issue_id,))]
+
+        return i
+
+    def _attach_archive(self, create=False):
+        """Attach the archive database as 'archive', if it isn't already.
+
+        Returns False, and attaches nothing, if there is no archive and create
+        is False. Also creates the temporary views AllIssue and AllComment,
+        which hold the repository's rows and the archive's together.
+
+        """
+
+        if self.conn.execute("select 1 from pragma_database_list where name = 'archive'").fetchone():
+            return True
+
+        path = self.storage.archive(create)
+
+        if path is None:
+            return False
+
+        self.conn.execute('attach database ? as archive', (path,))
+
+        for statement in ('create table if not exists archive.Issue({})'.format(_issue_columns),
+                          'create table if not exists archive.Comment({})'.format(_comment_columns),
+                          'create index if not exists archive.CommentIssueIndex on Comment(issueID)',
+                          """create temp view if not exists AllIssue as
+                             select id, type, date, status, priority, summary, description from main.Issue
+                             union all
+                             select id, type, date, status, priority, summary, description from archive.Issue""",
+                          """create temp view if not exists AllComment as
+                             select id, issueID, description from main.Comment
+                             union all
+                             select id, issueID, description from archive.Comment"""):
+            self.conn.execute(statement)
+
+        return True
+
+    def archive(self, closed_before):
+        """Move closed issues, and their comments, to the archive.
+
+        The archive is a separate database, .rabbit-archive, next to the
+        repository. Archived issues drop out of every list, search, count
+        and lookup, keeping them quick, unless the archive is asked for with
+        include_archived. An issue is archived if its last close was before
+        closed_before. Issues closed before the change log was kept count as
+        closed on their own date. Their changes are logged as 'archive'.
+
+        Returns the number of issues archived.
+
+        Keyword arguments:
+        closed_before -- date, as YYYY-MM-DD
+
+        """
+
+        try:
+            time.strptime(closed_before, '%Y-%m-%d')
+        except ValueError:
+            raise InvalidDateError(closed_before)
+
+        # attaching can't be done inside a transaction
+        self._attach_archive(create=True)
+
+        with self.transaction():
+            version = self.latest_change()
+
+            self.conn.execute('create temp table if not exists ArchiveBatch(id INTEGER PRIMARY KEY)')
+            self.conn.execute('delete from ArchiveBatch')
+            self.conn.execute("""insert into ArchiveBatch(id) select id from Issue i where status = 'closed'
+                                 and coalesce((select max(date) from Change c where c.issueID = i.id and action = 'close'),
+                                              i.date) < ?""", (closed_before,))
+
+            for statement in ("""insert into archive.Issue(id, type, date, status, priority, summary, description)
+                                 select id, type, date, status, priority, summary, description from main.Issue
+                                 where id in (select id from ArchiveBatch)""",
+                              # comments added before archived comment ids were
+                              # recorded may share an id with one already archived
+                              """insert into archive.Comment(id, issueID, description)
+                                 select case when c.id in (select id from archive.Comment) then null else c.id end,
+                                        issueID, description from main.Comment c
+                                 where issueID in (select id from ArchiveBatch)""",
+                              """insert into Archive(max_id, max_comment_id)
+                                 select max(id), (select max(id) from archive.Comment) from ArchiveBatch
+                                 having count(*) > 0""",
+                              'delete from main.Comment where issueID in (select id from ArchiveBatch)'):
+                self.conn.execute(statement)
+
+            count = self.conn.execute('delete from main.Issue where id in (select id from ArchiveBatch)').rowcount
+            self.conn.execute("update Change set action = 'archive' where version > ? and action = 'delete'", (version,))
+
+        self._cache.clear()
+
+        return count
+
+    def compact(self):
+        """Compress every long description and comment that isn't already,
+        tidy the search indexes, and VACUUM, to shrink the repository file.
+
+        New text is compressed as it is stored, so this is only needed for
+        text stored before compression existed, or to reclaim the space left
+        by deleted and archived issues. The archive is compacted too.
+
+        Returns the size of the repository, in bytes, before and after.
+
+        """
+
+        before = self._size()
+        archived = self._attach_archive()
+
+        with self.transaction():
+            for schema in ('main', 'archive') if archived else ('main',):
+                for table in ('Issue', 'Comment'):
+                    self.conn.execute("""update {0}.{1} set description = rabbit_pack(description)
+                                         where typeof(description) = 'text'
+                                         and length(cast(description as blob)) > ?""".format(schema, table),
+                                      (_compress_threshold,))
+
+            self.conn.execute("insert into IssueSearch(IssueSearch) values('optimize')")
+            self.conn.execute("insert into CommentSearch(CommentSearch) values('optimize')")
+
+        self.conn.execute('vacuum')
+
+        if archived:
+            self.conn.execute('vacuum archive')
+
+        # in wal mode, the vacuumed database is in the log until checkpointed
+        self.conn.execute('pragma wal_checkpoint(truncate)')
+
+        return before, self._size()
+
+    def _size(self):
+        return self.conn.execute('select page_count * page_size from pragma_page_count, pragma_page_size').fetchone()[0]
+
+    def snapshot(self, storage=None):
+        """Copy the whole repository into storage, with SQLite's backup API,
+        and return storage.
+
+        Snapshots can go between any kinds of storage, e.g. to load a file
+        repository into memory for a test, or to save one kept in memory.
+        The archive isn't copied.
+
+        Example:
+            saved = rabbit.snapshot()
+            ...
+            rabbit.restore(saved)
+
+        Keyword arguments:
+        storage -- storage to copy into, replacing whatever it holds.
+                   Defaults to a new MemoryStorage
+
+        """
+
+        storage = storage or MemoryStorage()
+        target = storage.open()
+
+        try:
+            _copy(self.conn, target)
+        finally:
+            target.close()
+
+        return storage
+
+    def restore(self, storage):
+        """Replace the whole repository with a copy of the one in storage,
+        e.g. a snapshot. See snapshot().
+
+        Change versions keep counting up from the highest one before the
+        restore, rather than from the copy's, so a client following changes
+        never sees a version used twice.
+
+        Keyword arguments:
+        storage -- storage to copy from
+
+        """
+
+        last = self.conn.execute("select max(seq) from sqlite_sequence where name = 'Change'").fetchone()[0] or 0
+        source = storage.open()
+
+        try:
+            _copy(source, self.conn)
+        finally:
+            source.close()
+
+        self._cache.clear()
+
+        with self.transaction():
+            seq = self.conn.execute("select seq from sqlite_sequence where name = 'Change'").fetchone()
+
+            if seq is None:
+                self.conn.execute("insert into sqlite_sequence(name, seq) values ('Change', ?)", (last,))
+            elif seq[0] < last:
+                self.conn.execute("update sqlite_sequence set seq = ? where name = 'Change'", (last,))
+
+    def _check_cache(self):
+        # data_version changes whenever another connection commits, so
+        # changes from other processes are never served stale
+        version = self.conn.execute('pragma data_version').fetchone()[0]
+
+        if version != self._data_version:
+            self._cache.clear()
+            self._data_version = version
+
+    def _invalidate(self, issue_ids=(), where=None):
+        """Drop the cached issues a change to issue_ids, or to the issues
+        matching where, could affect."""
+
+        issue_ids = set(int(i_id) for i_id in issue_ids)
+
+        for i_id, (r, comments) in list(self._cache.items()):
+            if issue_ids and i_id not in issue_ids:
+                continue
+
+            fields = dict(zip(('id', 'type', 'status', 'priority', 'summary', 'date'), r))
+
+            if all(field not in fields or str(fields[field]) == str(value) for field, value in (where or {}).items()):
+                del self._cache[i_id]
+
+    def issues(self, status_filter='all', include_comments=True):
+        """Return a list of all Issues in the repository.
+
+        Keyword arguments:
+        status_filter -- status, or query for parse_query, to filter. Pass all to return all
+        include_comments -- if False, compact IssueRows are returned instead, which only load their
+                            description and comments if they are used. Use this when only the summaries are needed.
+
+        """
+
+        return list(self.iter_issues(status_filter, include_comments=include_comments))
+
+    def iter_issues(self, query='all', page_size=500, after_id=0, limit=None, include_comments=False, include_archived=False):
+        """Generate IssueRows matching a query, one page at a time.
+
+        The query is compiled to SQL, so filtering, sorting and limiting all
+        happen in SQLite, using the indexes. Pages are fetched with keyset
+        pagination (where the sort key is past the last issue seen), so each
+        page costs the same no matter how deep into the results it is, and
+        the first issues are available before the rest have been read.
+
+        Unless include_comments is given, only the summary columns are read,
+        and compact IssueRows are generated, which load their description
+        and comments from the repository if they are used. Otherwise full
+        Issues are generated, with their comments fetched with a single
+        query per page.
+
+        Keyword arguments:
+        query -- Query, or query string for parse_query, e.g. 'status:open sort:-date'.
+                 A plain status, or all, works as well
+        page_size -- number of issues fetched from the database at a time
+        after_id -- only issues after the issue with this id, in the query's order, are returned
+        limit -- maximum number of issues to return, or None for no limit
+        include_comments -- if True, load the comments for each issue as well
+        include_archived -- if True, archived issues are generated too, see archive().
+                            Their IssueRows can't load descriptions or comments
+
+        """
+
+        if not isinstance(query, Query):
+            query = parse_query(query)
+
+        issue_table, comment_table = 'Issue', 'Comment'
+
+        if include_archived and self._attach_archive():
+            issue_table, comment_table = 'AllIssue', 'AllComment'
+
+        if query.limit is not None:
+            limit = query.limit if limit is None else min(limit, query.limit)
+
+        cursor = self.conn.cursor()
+
+        while limit is None or limit > 0:
+            size = page_size if limit is None else min(page_size, limit)
+            sql, params = query.compile(after_id, size, include_comments, issue_table)
+
+            cursor.execute(sql, params)
+
+            page = []
+            by_id = {}
+            for r in cursor:
+                if include_comments:
+                    i = Issue(r[0], r[1], r[2], r[3], r[4], r[5], _unpack(r[6]))
+                else:
+                    i = IssueRow(self, *r)
+
+                by_id[i.i_id] = i
+                page.append(i)
+
+            if not page:
+                return
+
+            if include_comments:
+                cursor.execute("""select id, issueID, description from {}
+                                  where issueID in (select id from ({}))
+                                  order by issueID, id""".format(comment_table, sql), params)
+
+                for c in cursor:
+                    by_id[c[1]].comments.append((c[0], _unpack(c[2])))
+
+            for i in page:
+                yield i
+
+            if len(page) < size:
+                return
+
+            after_id = page[-1].i_id
+
+            if limit is not None:
+                limit -= len(page)
+
+    def changes(self, since_version=0, limit=None):
+        """Return a list of Changes made after since_version, oldest first.
+
+        Every change made to an issue is logged by triggers, whoever makes
+        it, so a tool can keep up with a repository by remembering the
+        version of the last change it saw, and asking for the ones after it.
+
+        Keyword arguments:
+        since_version -- version of the last change already seen, or 0 for all
+        limit -- maximum number of changes to return, or None for no limit
+
+        """
 
+        rows = self.conn.execute("""select version, issueID, action, date from Change
+                                    where version > ? order by version limit ?""",
+                                 (since_version, -1 if limit is None else limit))
 
-"""Rabbit class, for managing bugs in the rabbit repository"""
-class Rabbit:
-    conn = None
+        return [Change(*r) for r in rows]
 
-    def __init__(self):
-        """Create the Rabbit object.
+    def latest_change(self):
+        """Return the version of the most recent change, or 0 if there are none.
 
-        Will raise MissingRepositoryError if you haven't initialised a
-        repository in the working directory
+        A tool that has just read the whole repository can start following
+        changes from here.
 
         """
 
-        if not os.path.isfile(_filename):
-            raise MissingRepositoryError()
+        return self.conn.execute('select coalesce(max(version), 0) from Change').fetchone()[0]
 
-        self.conn = sqlite3.connect(_filename)
+    def stats(self, rebuild=False):
+        """Return Stats counting the issues by status, type, priority and open age.
 
-    def __del__(self):
-        if self.conn:
-            self.conn.close()
+        The counts come from summary tables that triggers keep up to date, so
+        this takes the same time however many issues there are. Ages are
+        worked out from the number of open issues on each date.
 
-    @staticmethod
-    def init():
-        """Create the database file and create the tables."""
+        Keyword arguments:
+        rebuild -- if True, recount the summary tables from scratch first
 
-        if os.path.isfile(_filename):
-            raise RepositoryExistsError()
+        """
 
-        conn = sqlite3.connect(_filename)
+        if rebuild:
+            with self.transaction():
+                for statement in _rebuild_stats:
+                    self.conn.execute(statement)
 
-        issue_table = """create table Issue(id INTEGER PRIMARY KEY,
-                         type varchar(500),
-                         date varchar(10),
-                         status varchar(10),
-                         priority varchar(500),
-                         summary varchar(500),
-                         description varchar(500))"""
+        counts = {'status': {}, 'type': {}, 'priority': {}}
 
-        comment_table = """create table Comment(id INTEGER PRIMARY KEY,
-                           issueID INTEGER,
-                           description varchar(500))"""
+        for field, value, count in self.conn.execute('select field, value, count from IssueCount'):
+            counts[field][value] = count
 
-        conn.execute(issue_table)
-        conn.execute(comment_table)
-        conn.close()
-        print('Empty Rabbit repository created')
+        ages = self.conn.execute("""select
+                sum(case when age <= 7 then count else 0 end),
+                sum(case when age > 7 and age <= 30 then count else 0 end),
+                sum(case when age > 30 and age <= 90 then count else 0 end),
+                sum(case when age > 90 and age <= 365 then count else 0 end),
+                sum(case when age > 365 then count else 0 end),
+                sum(case when age is null then count else 0 end)
+            from (select julianday('now', 'localtime', 'start of day') - julianday(date) as age, count
+                  from OpenIssueDate)""").fetchone()
 
-    def add(self, issue):
-        """Add a new issue to the repository
+        open_age = list(zip(('up to a week', 'up to a month', 'up to 3 months',
+            'up to a year', 'over a year', 'unknown date'), [a or 0 for a in ages]))
+
+        return Stats(counts['status'], counts['type'], counts['priority'], open_age)
+
+    def explain(self, sql, params=()):
+        """Return SQLite's plan for a statement, as a list of lines, indented
+        to show which steps are part of which.
 
         Keyword arguments:
-        issue -- Issue object to be stored
+        sql -- statement to explain
+        params -- its parameters; their values don't change the plan, but
+                  there must be the right number of them
 
         """
 
-        if not issue.summary:
-            raise MissingSummaryError()
+        depth = {0: -1}
+        lines = []
+
+        for step, parent, unused, detail in self.conn.execute('explain query plan ' + sql, params):
+            depth[step] = depth.get(parent, -1) + 1
+            lines.append('  ' * depth[step] + detail)
 
-        self.conn.execute(issue.generate_insert())
-        self.conn.commit()
+        return lines
 
-    def close(self, issue_ids):
-        """Update the status of an issue to 'closed'
+    def query_plans(self, query='all', search='rabbit'):
+        """Return a list of (name, sql, plan lines) for the queries behind
+        rabbit list, detail and search.
 
         Keyword arguments:
-        issue_ids -- set of integer ids to be closed
+        query -- query for parse_query, as given to rabbit list
+        search -- FTS5 query, as given to rabbit search
 
         """
 
-        for i_id in issue_ids:
-            self.conn.execute("update Issue set status='closed' where id = {0}".format(i_id))
+        if not isinstance(query, Query):
+            query = parse_query(query)
+
+        queries = [
+            ('list', query.compile(0, 500)),
+            ('list, next page', query.compile(1, 500)),
+            ('detail', ("""select id, type, status, priority, summary, date, description
+                           from Issue where id in (?)""", (1,))),
+            ('detail comments', ("""select id, issueID, description from Comment
+                                    where issueID in (?) order by id""", (1,))),
+            ('search', (_search_sql, (search, search, 20))),
+        ]
 
-        self.conn.commit()
+        return [(name, sql, self.explain(sql, params)) for name, (sql, params) in queries]
 
-    def open(self, issue_ids):
-        """Update the status of an issue to 'open'
+    def search(self, query, limit=20):
+        """Return a list of SearchResults for issues matching a full text query.
+
+        Issue summaries, descriptions and comments are all searched. Each issue
+        appears at most once, with the snippet of its best matching text, and
+        results are ordered best match first.
 
         Keyword arguments:
-        issue_ids -- set of integers ids to be opened
+        query -- SQLite FTS5 query string, e.g. 'segfault', 'search OR find'
+        limit -- maximum number of results to return
 
         """
 
-        for i_id in issue_ids:
-            self.conn.execute("update Issue set status='open' where id = {0}".format(i_id))
 
-        self.conn.commit()
+        try:
+            rows = self.conn.execute(_search_sql, (query, query, limit)).fetchall()
+        except sqlite3.OperationalError:
+            raise InvalidSearchError(query)
 
-    def update(self, issue):
-        """Update an issue in the database
+        return [SearchResult(r[0], r[1], r[2], r[3]) for r in rows]
 
-        Keyword arguments:
-        issue -- Issue object to be updated in the database
 
-        """
+import sys
+import getopt
 
-        if not issue.summary:
-            raise MissingSummaryError()
+def query_terms(args):
+    """Return the query terms given as command line arguments, for parse_query.
 
-        self.conn.execute(issue.generate_update())
-        self.conn.commit()
+    The shell has already removed the user's quoting, so each argument is
+    split on its own, never joined with the others: 'status:open sort:-date'
+    is two terms, but in type:'bug fix' a word without a colon continues
+    the value before it. An argument whose quotes don't pair up, e.g.
+    summary:don't, is taken as it is.
 
-    def delete(self, issue_id):
-        """Delete an issue and all associated comments.
+    """
 
-        Keyword arguments:
-        issue_id -- integer id of the Issue to be removed.
+    import shlex
 
-        """
+    terms = []
 
-        self.conn.execute('delete from Comment where issueID = {}'.format(issue_id))
-        self.conn.execute('delete from Issue where id = {}'.format(issue_id))
-        self.conn.commit()
+    for arg in args:
+        try:
+            words = shlex.split(arg)
+        except ValueError:
+            terms.append(arg)
+            continue
 
-    def comment(self, issue_id, comment):
-        """Add a comment to an issue
+        for n, word in enumerate(words):
+            if n > 0 and ':' not in word:
+                terms[-1] += ' ' + word
+            else:
+                terms.append(word)
 
-        Keyword arguments:
-        issue_id -- issue id to add a comment to
-        comment -- string containing the comment.
+    return terms
 
-        """
+_issue_options = ["type=", "status=", "priority=", "description=", "summary="]
 
-        self.conn.execute("Insert into Comment(issueID, description) values({}, '{}')".format(issue_id, comment.replace("'", "''")))
-        self.conn.commit()
+_export_fields = ('id', 'type', 'date', 'status', 'priority', 'summary', 'description', 'comments')
 
-    def issue(self, issue_id):
-        """Return a specific Issue
+def export_issues(issues, out, format='jsonl'):
+    """Write issues to a file object, one record per issue.
 
-        TODO: Add comment retrieval in as well.
+    JSONL records hold the comments as a list of strings. CSV rows hold them
+    as a JSON encoded list in the comments column.
 
-        Keyword arguments:
-        issue_id -- id of the issue to return
+    Keyword arguments:
+    issues -- iterable of Issue objects, e.g. from Rabbit.dump()
+    out -- text file object to write to
+    format -- 'jsonl' or 'csv'
 
-        """
+    """
 
-        cursor = self.conn.cursor()
+    import csv
+    import json
 
-        query = "select id, type, status, priority, summary, date, description from Issue where id = {}".format(issue_id)
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(_export_fields)
 
-        cursor.execute(query)
-        r = cursor.fetchone()
+    for i in issues:
+        comments = [c[1] for c in i.comments]
 
-        if r is None:
-            raise NonexistentIssueError()
+        if format == 'csv':
+            writer.writerow((i.i_id, i.type, i.date, i.status, i.priority,
+                i.summary, i.description, json.dumps(comments)))
+        else:
+            out.write(json.dumps({'id': i.i_id, 'type': i.type, 'date': i.date,
+                'status': i.status, 'priority': i.priority, 'summary': i.summary,
+                'description': i.description, 'comments': comments}) + '\n')
 
-        i = Issue(r[0], r[1], r[2], r[3], r[4], r[5], r[6])
+def import_issues(source, format='jsonl'):
+    """Generate Issues from a file object written by export_issues.
 
-        query = "select id, description from Comment where issueID = {}".format(issue_id)
-        cursor.execute(query)
+    Missing fields take the same defaults as Issue(). Records are read
+    lazily, so this can be passed straight to Rabbit.add_many(). Raises
+    InvalidRecordError, with its line number, for a record that can't be read.
 
-        for row in cursor:
-            i.comments.append((row[0], row[1]))
+    Keyword arguments:
+    source -- text file object to read from
+    format -- 'jsonl' or 'csv'
 
-        return i
+    """
 
-    def issues(self, status_filter='all'):
-        """Return a list of all Issues in the repository.
+    import csv
+    import json
+
+    if format == 'csv':
+        reader = csv.DictReader(source)
+        records = ((reader.line_num, r) for r in reader)
+    else:
+        records = ((number, line) for number, line in enumerate(source, 1) if line.strip())
 
-        TODO: Add comment retrieval in as well.
+    try:
+        for number, r in records:
+            if format != 'csv':
+                try:
+                    r = json.loads(r)
+                except ValueError as e:
+                    raise InvalidRecordError(number, e)
 
-        Keyword arguments:
-        status_filter -- status to filter. Default results in all open bugs being returned. Pass all to return all
+                if not isinstance(r, dict):
+                    raise InvalidRecordError(number, 'not a JSON object')
 
-        """
+            i = Issue()
 
-        cursor = self.conn.cursor()
-        comments = self.conn.cursor()
+            for field in ('type', 'date', 'status', 'priority', 'summary', 'description'):
+                if r.get(field) is not None:
+                    setattr(i, field, r[field])
 
-        query = "select id, type, status, priority, summary, date, description from Issue where status = '{0}'".format(status_filter)
+            comments = r.get('comments')
 
-        if status_filter in ('all', ''):
-            query = "select id, type, status, priority, summary, date, description from Issue"
+            # CSV files from elsewhere may have an empty comments column, or none
+            if format == 'csv' and isinstance(comments, str):
+                try:
+                    comments = json.loads(comments) if comments.strip() else None
+                except ValueError as e:
+                    raise InvalidRecordError(number, 'comments: {}'.format(e))
 
-        cursor.execute(query)
+            if comments is None:
+                comments = []
 
-        issues = []
-        for r in cursor:
-            comments.execute('select id, description from Comment where issueID = {}'.format(r[0]))
+            if not isinstance(comments, list) or not all(isinstance(c, str) for c in comments):
+                raise InvalidRecordError(number, 'comments must be a list of strings')
 
-            i = Issue(r[0], r[1], r[2], r[3], r[4], r[5], r[6])
+            i.comments = comments
 
-            for c in comments:
-                i.comments.append((c[0], c[1]))
+            yield i
+    except csv.Error as e:
+        raise InvalidRecordError(reader.line_num, e)
 
-            issues.append(i)
+def _file_format(opts, filename):
+    """Return the import/export format chosen by -f, or implied by filename."""
 
-        return issues
+    for opt, arg in opts:
+        if opt in ('-f', '--format'):
+            if arg not in ('jsonl', 'csv'):
+                raise IllegalFormatError(arg)
+            return arg
 
+    if filename and filename.endswith('.csv'):
+        return 'csv'
 
-import sys
-import getopt
+    return 'jsonl'
+
+def usage(argv=None):
+    argv = argv or sys.argv
 
-def usage():
     try:
-        command = sys.argv[2]
-        if command not in ('add', 'list', 'detail', 'comment', 'rm', 'update', 'close', 'open'):
+        command = argv[2]
+        if command not in ('add', 'list', 'detail', 'search', 'comment', 'rm', 'update', 'close', 'open', 'import', 'export', 'batch', 'stats', 'changes', 'repos', 'explain', 'archive', 'compact', 'config', 'serve'):
             raise IllegalCommandError(command)
 
         if command == 'add':
@@ -311,35 +2349,149 @@ def usage():
                   "\n  -p, --priority=PRIORITY        issue priority, e.g. high, medium, low")
 
         elif command == 'list':
-            print("Usage: rabbit list [STATUS]" +
-                  "\nList issues, filtered by STATUS." +
-                  "\nExample: rabbit list open")
+            print("Usage: rabbit list [QUERY]... [OPTION]" +
+                  "\nList issues matching every term of QUERY." +
+                  "\nQuery terms:" +
+                  "\n  FIELD:VALUE[,VALUE]...         FIELD is one of the VALUEs. Fields are" +
+                  "\n                                 id, type, date, status, priority, summary" +
+                  "\n  -FIELD:VALUE[,VALUE]...        FIELD is none of the VALUEs" +
+                  "\n  since:DATE, until:DATE         issues dated on or after/before DATE" +
+                  "\n  sort:FIELD, sort:-FIELD        sort by FIELD, ascending or descending" +
+                  "\n  limit:N                        show at most N issues" +
+                  "\n  STATUS                         same as status:STATUS" +
+                  "\nOptions:" +
+                  "\n  -n, --limit=N                  show at most N issues" +
+                  "\n  -a, --after=ID                 only show issues after issue ID, in sort order" +
+                  "\n      --all-repos                list issues from every registered repository" +
+                  "\n      --include-archived         list archived issues as well" +
+                  "\nExample: rabbit list 'status:open priority:high since:2011-07-01 sort:-date'")
 
         elif command == 'detail':
-            print("Usage: rabbit detail [ID]" +
-                  "\nDetailed description of an issue, showing comments and extended info.")
+            print("Usage: rabbit detail [ID] [--include-archived]" +
+                  "\nDetailed description of an issue, showing comments and extended info." +
+                  "\nWith --include-archived, archived issues can be shown too.")
+
+        elif command == 'archive':
+            print("Usage: rabbit archive --closed-before DATE" +
+                  "\nMove issues closed before DATE, and their comments, out of the" +
+                  "\nrepository into its archive, .rabbit-archive. Archived issues are only" +
+                  "\nlisted and shown when asked for with --include-archived." +
+                  "\nOptions:" +
+                  "\n  -b, --closed-before=DATE       archive issues closed before DATE, YYYY-MM-DD" +
+                  "\nExample: rabbit archive --closed-before 2012-01-01")
+
+        elif command == 'search':
+            print("Usage: rabbit search QUERY..." +
+                  "\nSearch issue summaries, descriptions and comments, best matches first." +
+                  "\nWith --all-repos, every registered repository is searched." +
+                  "\nExample: rabbit search segfault OR crash")
 
         elif command == 'comment':
             print("Usage: rabbit comment [ID] [COMMENT]")
         elif command == 'rm':
-            print("Usage: rabbit rm [ID]")
+            print("Usage: rabbit rm [ID]... [--where FIELD=VALUE[,FIELD=VALUE]...]" +
+                  "\nRemove a set of issues, or every issue matching the criteria." +
+                  "\nExample: rabbit rm --where status=closed,type=wontfix")
 
         elif command == 'update':
-            print("Usage: rabbit update [ID] [OPTION]" +
+            print("Usage: rabbit update [ID]... [OPTION]" +
+                  "\nModify an issue. Given several IDs, or --where, only the fields" +
+                  "\ngiven are changed, on every matching issue." +
                   "\nOptions:" +
                   "\n  -b, --summary=SUMMARY          brief description of the issue"+
                   "\n  -d, --description=DESCRIPTION  extended description of the issue" +
                   "\n  -t, --type=TYPE                type of issue, e.g. enhancement, bug" +
                   "\n  -s, --status=STATUS            status of the problem, e.g. open, closed" +
-                  "\n  -p, --priority=PRIORITY        issue priority, e.g. high, medium, low")
+                  "\n  -p, --priority=PRIORITY        issue priority, e.g. high, medium, low" +
+                  "\n  -w, --where=FIELD=VALUE,...    update every issue matching the criteria")
 
         elif command == 'close':
-            print("Usage: rabbit close [ID]..." +
-                  "\nClose a set of issues.")
+            print("Usage: rabbit close [ID]... [--where FIELD=VALUE[,FIELD=VALUE]...]" +
+                  "\nClose a set of issues, or every issue matching the criteria." +
+                  "\nExample: rabbit close --where status=open,type=wontfix")
+
+        elif command == 'open':
+            print("Usage: rabbit open [ID]... [--where FIELD=VALUE[,FIELD=VALUE]...]" +
+                  "\nRe-open a set of issues, or every issue matching the criteria.")
+
+        elif command == 'import':
+            print("Usage: rabbit import [FILE] [OPTION]" +
+                  "\nAdd every issue in FILE, or standard input, in a single transaction." +
+                  "\nOptions:" +
+                  "\n  -f, --format=FORMAT            jsonl or csv, default from FILE's extension")
+
+        elif command == 'stats':
+            print("Usage: rabbit stats [OPTION]" +
+                  "\nCount issues by status, type and priority, and open issues by age." +
+                  "\nOptions:" +
+                  "\n  -r, --rebuild                  recount everything from scratch first")
+
+        elif command == 'compact':
+            print("Usage: rabbit compact" +
+                  "\nShrink the repository: compress long descriptions and comments stored" +
+                  "\nbefore rabbit compressed them, tidy the search indexes and VACUUM." +
+                  "\nOther rabbit commands wait while it runs.")
+
+        elif command == 'explain':
+            print("Usage: rabbit explain [list [QUERY]...|detail|search [QUERY]...]" +
+                  "\nShow how SQLite runs the queries behind list, detail and search:" +
+                  "\nwhich indexes they use, and where they scan or sort." +
+                  "\nTo see the queries a command runs, and how long each takes, add" +
+                  "\n--trace to it, or set RABBIT_TRACE=1. The trace, and a breakdown of" +
+                  "\nthe command's time, are written to standard error. --timing writes" +
+                  "\njust the breakdown." +
+                  "\nExample: rabbit explain list 'status:open sort:-date'")
+
+        elif command == 'repos':
+            print("Usage: rabbit repos [add|rm] [DIRECTORY]..." +
+                  "\nShow, add to or remove from the registry of repositories searched" +
+                  "\nby list --all-repos and search --all-repos. add with no DIRECTORY" +
+                  "\nregisters the repository rabbit is being run in." +
+                  "\nExample: rabbit repos add ~/projects/rabbit")
+
+        elif command == 'changes':
+            print("Usage: rabbit changes [OPTION]" +
+                  "\nList changes to issues, oldest first: version, issue ID, action" +
+                  "\n(add, update, close, open, comment or delete) and UTC date. Pass the" +
+                  "\nlast version seen to --since to see only the changes made after it." +
+                  "\nOptions:" +
+                  "\n  -s, --since=VERSION            only changes after VERSION" +
+                  "\n  -n, --limit=N                  show at most N changes" +
+                  "\n  -j, --jsonl                    write changes as JSON lines" +
+                  "\nExample: rabbit changes --since 1042")
+
+        elif command == 'batch':
+            print("Usage: rabbit batch [OPTION]" +
+                  "\nRun commands read from standard input, one per line, in a single" +
+                  "\ntransaction. A command that fails is undone and reported, and the" +
+                  "\nrest still run. import must be given a FILE, as standard input is" +
+                  "\nthe batch itself." +
+                  "\nOptions:" +
+                  "\n  -j, --jsonl                    each line is a JSON list of arguments," +
+                  "\n                                 and results are written as JSON lines" +
+                  "\nExample: echo \"close 4 5\" | rabbit batch")
+
+        elif command == 'serve':
+            print("Usage: rabbit serve" +
+                  "\nKeep the repository open and serve commands on a Unix socket," +
+                  "\n.rabbit.sock beside it, until interrupted. While it runs, other" +
+                  "\nrabbit commands using the repository are handed to it, and" +
+                  "\nstart faster.")
+
+        elif command == 'config':
+            print("Usage: rabbit config [NAME] [VALUE]" +
+                  "\nShow or change the repository's settings." +
+                  "\nSettings:" +
+                  "\n  journal_mode    wal (the default), delete, truncate or persist" +
+                  "\n  synchronous     off, normal, full or extra" +
+                  "\n  busy_timeout    milliseconds to wait for other processes' locks" +
+                  "\nExample: rabbit config busy_timeout 10000")
 
         else:
-            print("Usage: rabbit open [ID]..." +
-                  "\nRe-open a set of issues.")
+            print("Usage: rabbit export [FILE] [OPTION]" +
+                  "\nWrite every issue and its comments to FILE, or standard output." +
+                  "\nOptions:" +
+                  "\n  -f, --format=FORMAT            jsonl or csv, default from FILE's extension")
 
     except IndexError:
         print("Usage: rabbit [COMMAND] [OPTION]..." +
@@ -348,36 +2500,104 @@ def usage():
           "\n  add        Add an issue" +
           "\n  list       List all issues" +
           "\n  detail     Detailed info about an issue" +
+          "\n  search     Search issues and comments" +
           "\n  comment    Add a comment to an issue" +
           "\n  rm         Remove an issue" +
           "\n  update     Modify an issue" +
           "\n  close      Close an issue" +
           "\n  open       Re-open an issue" +
+          "\n  import     Add issues from a JSONL or CSV file" +
+          "\n  export     Write all issues to a JSONL or CSV file" +
+          "\n  stats      Count issues by status, type, priority and age" +
+          "\n  changes    List changes to issues since a version" +
+          "\n  repos      Show or change the registry of known repositories" +
+          "\n  archive    Move old closed issues into the archive" +
+          "\n  compact    Compress old text and shrink the repository file" +
+          "\n  explain    Show the query plans behind list, detail and search" +
+          "\n  batch      Run many commands from standard input" +
+          "\n  config     Show or change repository settings" +
+          "\n  serve      Serve commands from a background daemon" +
           "\n\nExtended help for any command is accessible via 'rabbit help [COMMAND]'")
 
 class RabbitConsole:
-    def __init__(self):
-        self.rabbit = Rabbit()
+    def __init__(self, argv=None, rabbit=None, term_width=None, trace=None):
+        """Run the command given by argv.
+
+        Keyword arguments:
+        argv -- command line, including the program name. Defaults to sys.argv
+        rabbit -- Rabbit object to use, rather than opening the repository
+        term_width -- width of the terminal output is for. Defaults to the
+                      width of this process's terminal
+        trace -- Tracer for the repository, when this opens it
 
-        command = sys.argv[1]
+        """
+
+        self.argv = argv or sys.argv
+        self._rabbit = rabbit
+        self.term_width = term_width
+        self.trace = trace
+
+        command = self.argv[1]
 
         if command == 'add':
-            issue = self._parse_args()
-            self.rabbit.add(issue)
+            opts, args = getopt.getopt(self.argv[2:], "t:s:p:d:b:", _issue_options)
+            self.rabbit.add(self._parse_args(opts, Issue()))
 
         elif command == 'update':
-            issue = self._parse_args()
-            self.rabbit.update(issue)
+            opts, args = getopt.gnu_getopt(self.argv[2:], "t:s:p:d:b:w:", _issue_options + ["where="])
+            where = self._parse_where(opts)
+            issue_ids = self._parse_ids(args)
+
+            if where is None and len(issue_ids) == 1:
+                issue = self._parse_args(opts, self.rabbit.issue(issue_ids[0]))
+                self.rabbit.update(issue)
+            else:
+                changes = self._parse_args(opts, {})
+                print('Updated {} issues'.format(self.rabbit.update_many(changes, issue_ids, where)))
 
         elif command == 'list':
+            # negated query terms, like -status:closed, aren't options
+            terms = [a for a in self.argv[2:] if a.startswith('-') and ':' in a]
+            opts, args = getopt.gnu_getopt([a for a in self.argv[2:] if a not in terms],
+                "n:a:", ["limit=", "after=", "all-repos", "include-archived"])
+
+            limit = None
+            after_id = 0
+            all_repos = False
+            include_archived = False
+
             try:
-                self.display(sys.argv[2])
-            except IndexError:
-                self.display('')
+                for opt, arg in opts:
+                    if opt in ('-n', '--limit'):
+                        limit = int(arg)
+                    if opt in ('-a', '--after'):
+                        after_id = int(arg)
+                    if opt == '--all-repos':
+                        all_repos = True
+                    if opt == '--include-archived':
+                        include_archived = True
+            except ValueError:
+                print('Limit and ID must be numbers!')
+                sys.exit(1)
+
+            query = query_terms(args + terms)
+
+            if all_repos:
+                # parsed here, so a bad query is reported once, not per repository
+                query = parse_query(query)
+
+                for path, issues, error in federated(lambda r: list(r.iter_issues(query, limit=limit, after_id=after_id,
+                        include_archived=include_archived))):
+                    self.display_repository(path, error)
+                    self.display_issues(issues or [])
+            else:
+                self.display(query, limit, after_id, include_archived)
 
         elif command == 'detail':
+            args = [a for a in self.argv[2:] if a != '--include-archived']
+
             try:
-                self.display_detail(int(sys.argv[2]))
+                self.display_detail(int(args[0]), len(args) < len(self.argv) - 2)
             except ValueError:
                 print('Issue ID must be a number!')
                 sys.exit(1)
@@ -385,9 +2605,68 @@ class RabbitConsole:
                 print('You must provide an Issue ID')
                 sys.exit(1)
 
+        elif command == 'search':
+            terms = [a for a in self.argv[2:] if a != '--all-repos']
+
+            if not terms:
+                print('You must provide a search query')
+                sys.exit(1)
+
+            if len(terms) < len(self.argv) - 2:
+                for path, results, error in federated(lambda r: r.search(' '.join(terms))):
+                    self.display_repository(path, error)
+
+                    for result in results or []:
+                        print(result)
+            else:
+                self.display_search(' '.join(terms))
+
+        elif command == 'archive':
+            opts, args = getopt.gnu_getopt(self.argv[2:], "b:", ["closed-before="])
+
+            if not opts:
+                raise MissingArgumentError()
+
+            print('Archived {} issues'.format(self.rabbit.archive(opts[0][1])))
+
+        elif command == 'compact':
+            before, after = self.rabbit.compact()
+            print('Compacted {} from {} KB to {} KB'.format(_filename, before // 1024, after // 1024))
+
+        elif command == 'explain':
+            names = {'list': ('list', 'list, next page'), 'detail': ('detail', 'detail comments'), 'search': ('search',)}
+            which = self.argv[2] if len(self.argv) > 2 else None
+
+            if which is not None and which not in names:
+                raise IllegalCommandError(which)
+
+            terms = self.argv[3:]
+            plans = self.rabbit.query_plans(query_terms(terms) if which == 'list' and terms else 'all',
+                ' '.join(terms) if which == 'search' and terms else 'rabbit')
+
+            for name, sql, plan in plans:
+                if which is None or name in names[which]:
+                    print('{}: {}'.format(name, ' '.join(sql.split())))
+
+                    for line in plan:
+                        print('    ' + line)
+
+        elif command == 'repos':
+            if len(self.argv) > 3 and self.argv[2] == 'rm':
+                for path in self.argv[3:]:
+                    unregister_repository(path)
+            elif len(self.argv) > 2 and self.argv[2] == 'add':
+                for path in self.argv[3:] or [find_repository() or '.']:
+                    print('Registered', register_repository(path))
+            elif len(self.argv) == 2:
+                for path in registered_repositories():
+                    print(path if os.path.isfile(os.path.join(path, _filename)) else path + ' (missing)')
+            else:
+                raise MissingArgumentError()
+
         elif command == 'comment':
             try:
-                self.rabbit.comment(int(sys.argv[2]), sys.argv[3])
+                self.rabbit.comment(int(self.argv[2]), self.argv[3])
             except ValueError:
                 print('Issue ID must be a number!')
                 sys.exit(1)
@@ -395,76 +2674,253 @@ class RabbitConsole:
                 print('You must provide an Issue ID and a comment!')
                 sys.exit(1)
 
-        elif command == 'rm':
+        elif command in ('rm', 'close', 'open'):
+            opts, args = getopt.gnu_getopt(self.argv[2:], "w:", ["where="])
+            where = self._parse_where(opts)
+            issue_ids = self._parse_ids(args)
+
+            if command == 'rm':
+                print('Removed {} issues'.format(self.rabbit.delete(issue_ids, where)))
+            elif command == 'close':
+                print('Closed {} issues'.format(self.rabbit.close(issue_ids, where)))
+            else:
+                print('Opened {} issues'.format(self.rabbit.open(issue_ids, where)))
+
+        elif command == 'import':
+            opts, args = getopt.gnu_getopt(self.argv[2:], "f:", ["format="])
+            format = _file_format(opts, args[0] if args else None)
+
             try:
-                self.rabbit.delete(sys.argv[2])
-            except IndexError:
-                print('Missing ID')
+                if args:
+                    with open(args[0], newline='') as source:
+                        count = self.rabbit.add_many(import_issues(source, format))
+                else:
+                    count = self.rabbit.add_many(import_issues(sys.stdin, format))
+            except (OSError, ValueError) as e:
+                # missing files, and files that aren't text
+                print('rabbit:', e)
                 sys.exit(1)
 
-        elif command == 'close':
-            try:
-                self.rabbit.close([int(x) for x in sys.argv[2:]])
-            except ValueError:
-                print('IDs must be numbers!')
+            print('Imported {} issues'.format(count))
+
+        elif command == 'export':
+            opts, args = getopt.gnu_getopt(self.argv[2:], "f:", ["format="])
+            format = _file_format(opts, args[0] if args else None)
+
+            if args:
+                with open(args[0], 'w', newline='') as out:
+                    export_issues(self.rabbit.dump(), out, format)
+            else:
+                export_issues(self.rabbit.dump(), sys.stdout, format)
+
+        elif command == 'stats':
+            opts, args = getopt.gnu_getopt(self.argv[2:], "r", ["rebuild"])
+            print(self.rabbit.stats(rebuild=bool(opts)))
+
+        elif command == 'batch':
+            opts, args = getopt.gnu_getopt(self.argv[2:], "j", ["jsonl"])
+
+            if not self.batch(sys.stdin, bool(opts)):
                 sys.exit(1)
 
-        elif command == 'open':
+        elif command == 'changes':
+            opts, args = getopt.gnu_getopt(self.argv[2:], "s:n:j", ["since=", "limit=", "jsonl"])
+
+            since = 0
+            limit = None
+            jsonl = False
+
             try:
-                self.rabbit.open([int(x) for x in sys.argv[2:]])
+                for opt, arg in opts:
+                    if opt in ('-s', '--since'):
+                        since = int(arg)
+                    if opt in ('-n', '--limit'):
+                        limit = int(arg)
+                    if opt in ('-j', '--jsonl'):
+                        jsonl = True
             except ValueError:
-                print('IDs must be numbers!')
+                print('Version and limit must be numbers!')
                 sys.exit(1)
 
+            for c in self.rabbit.changes(since, limit):
+                if jsonl:
+                    import json
+
+                    print(json.dumps({'version': c.version, 'id': c.i_id, 'action': c.action, 'date': c.date}))
+                else:
+                    print(c)
+
+        elif command == 'config':
+            if len(self.argv) > 3:
+                self.rabbit.configure(self.argv[2], self.argv[3])
+            elif len(self.argv) == 3:
+                settings = self.rabbit.settings()
+
+                if self.argv[2] not in settings:
+                    raise InvalidSettingError(self.argv[2])
+
+                print(settings[self.argv[2]])
+            else:
+                for name, value in sorted(self.rabbit.settings().items()):
+                    print('{} = {}'.format(name, value))
+
         elif command == 'help':
-            usage()
+            usage(self.argv)
         else:
             raise IllegalCommandError(command)
 
-    def _parse_args(self):
-        sys_args = sys.argv[2:] if sys.argv[1] == 'add' else sys.argv[3:]
+    @property
+    def rabbit(self):
+        # opened on first use, as some commands, like list --all-repos,
+        # don't need a repository here
+        if self._rabbit is None:
+            start = time.perf_counter()
+            self._rabbit = Rabbit(trace=self.trace)
+
+            if self.trace:
+                self.trace.opened(time.perf_counter() - start)
 
-        opts, args = getopt.getopt(sys_args, "t:s:p:d:b:",
-            ["type=", "status=", "priority=", "description=", "summary="])
+        return self._rabbit
 
-        i = Issue()
+    def _parse_args(self, opts, issue):
+        """Apply the issue options in opts to issue.
 
-        if sys.argv[1] == 'update':
-            i = self.rabbit.issue(int(sys.argv[2]))
+        issue may be an Issue, or a dict which is filled with only the fields
+        that were given, for use with Rabbit.update_many.
+
+        """
 
-        if not opts:
+        if not [opt for opt, arg in opts if opt not in ('-w', '--where')]:
             raise MissingArgumentError()
 
+        fields = {'-t': 'type', '--type': 'type', '-s': 'status',
+                  '--status': 'status', '-p': 'priority', '--priority': 'priority',
+                  '-d': 'description', '--description': 'description',
+                  '-b': 'summary', '--summary': 'summary'}
+
         for opt, arg in opts:
-            if opt in ('-t', '--type'):
-                i.type = arg.replace("'", "''")
-            if opt in ('-s', '--status'):
-                i.status = arg.replace("'", "''")
-            if opt in ('-p', '--priority'):
-                i.priority = arg.replace("'", "''")
-            if opt in ('-d', '--description'):
-                i.description = arg.replace("'", "''")
-            if opt in ('-b', '--brief'):
-                i.summary = arg.replace("'", "''")
+            if opt not in fields:
+                continue
 
-        return i
+            if isinstance(issue, dict):
+                issue[fields[opt]] = arg
+            else:
+                setattr(issue, fields[opt], arg)
+
+        return issue
+
+    def _parse_where(self, opts):
+        for opt, arg in opts:
+            if opt in ('-w', '--where'):
+                return parse_where(arg)
+
+        return None
+
+    def _parse_ids(self, args):
+        try:
+            return [int(x) for x in args]
+        except ValueError:
+            print('IDs must be numbers!')
+            sys.exit(1)
+
+    def batch(self, lines, jsonl=False):
+        """Run many commands, one per line, in a single transaction.
+
+        Each command runs under a savepoint, so one that fails is undone
+        without losing the others. Returns True if every command succeeded.
+
+        Keyword arguments:
+        lines -- iterable of command lines, without the leading 'rabbit',
+                 e.g. 'close 4 5'. If jsonl, each is a JSON list of arguments.
+        jsonl -- if True, read JSON lines and write one JSON result per line
+
+        """
+
+        import io
+        import json
+        import shlex
+
+        succeeded = True
+        conn = self.rabbit.conn
+
+        with self.rabbit.transaction():
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+
+                output = io.StringIO()
+                conn.execute('savepoint batch')
+
+                with contextlib.redirect_stdout(output):
+                    try:
+                        args = json.loads(line) if jsonl else shlex.split(line)
+
+                        if not isinstance(args, list) or not all(isinstance(a, str) for a in args):
+                            raise ValueError('each line must be a JSON list of strings')
 
-    def display(self, status):
-        issues = self.rabbit.issues(status)
+                        if args and args[0] in ('init', 'serve', 'batch'):
+                            raise IllegalCommandError(args[0])
 
-        if len(issues) == 0:
+                        # standard input is the batch itself
+                        if args and args[0] == 'import' and not getopt.gnu_getopt(args[1:], "f:", ["format="])[1]:
+                            raise ValueError('import needs a FILE in a batch')
+
+                        status = main(['rabbit'] + args, self.rabbit, self.term_width)
+                    except SystemExit as e:
+                        status = e.code if isinstance(e.code, int) else 1
+                    except (ValueError, IllegalCommandError, sqlite3.Error, getopt.GetoptError) as e:
+                        print('rabbit:', e)
+                        status = 1
+                    except Exception as e:
+                        # fail this line only; the others are still committed
+                        print('rabbit: {}: {}'.format(type(e).__name__, e))
+                        status = 1
+
+                if status == 0:
+                    conn.execute('release batch')
+                else:
+                    conn.execute('rollback to batch')
+                    conn.execute('release batch')
+                    succeeded = False
+
+                if jsonl:
+                    print(json.dumps({'line': number, 'status': status, 'output': output.getvalue()}))
+                elif status == 0:
+                    sys.stdout.write(output.getvalue())
+                    print('{}: ok'.format(number))
+                else:
+                    print('{}: failed: {}'.format(number, output.getvalue().strip()))
+
+        return succeeded
+
+    def display(self, query, limit=None, after_id=0, include_archived=False):
+        self.display_issues(self.rabbit.iter_issues(query, limit=limit, after_id=after_id,
+            include_archived=include_archived))
+
+    def display_repository(self, path, error=None):
+        """Print the heading for one repository's results, and its error if it failed."""
+
+        print('{}:'.format(path))
+
+        if error is not None:
+            print('rabbit:', error)
+
+    def display_issues(self, issues):
+        issues = iter(issues)
+        first = next(issues, None)
+
+        if first is None:
             return
 
-        if sys.platform == 'win32':
-            term_width = 80
-        else:
-            term_width = int(os.popen('stty size', 'r').read().split()[1])
+        term_width = self.term_width
 
+        if term_width is None:
+            term_width = terminal_width()
 
         prettify = lambda text, max_length: text[:max_length - 3].replace(
             '\n', '') + '...' if len(text) > max_length else text.replace('\n', '')
 
-        i = issues[0]
+        i = first
 
         available_width = term_width - len("| {:>2} | {:<11} | {} | {:<6} | {:<6} | ".format(
             i.i_id, prettify(i.type, 11), i.date, i.status, i.priority)) - 4
@@ -474,27 +2930,24 @@ class RabbitConsole:
         if available_width < 1:
             available_width = 80
 
-        summary = ":<{}".format(available_width)
+        # built once, rather than for every row
+        row = "| {{:>2}} | {{:<11}} | {{}} | {{:<6}} | {{:<8}} | {{:<{}}} |".format(available_width).format
 
-        nice_bars = "".join(['*' for i in range(term_width)])
+        nice_bars = '*' * term_width
 
         print(nice_bars)
         print("| {:>2} | {:<11} | {:<10} | {:<6} | {} | ".format(
-            'id', 'type', 'date', 'status', 'priority') + str('{' + summary + '} |').format('summary'))
+            'id', 'type', 'date', 'status', 'priority') + str('{:<' + str(available_width) + '} |').format('summary'))
         print(nice_bars)
 
-        # get terminal width
-        for i in issues:
-            first_half = "| {:>2} | {:<11} | {} | {:<6} | {:<8} | ".format(
-                i.i_id, prettify(i.type, 11), i.date, i.status, i.priority)
-
-            final_line = first_half + '{' + summary + '}'
-            print(final_line.format(prettify(i.summary, available_width)), '|')
+        for i in itertools.chain([first], issues):
+            print(row(i.i_id, prettify(i.type, 11), i.date, i.status, i.priority,
+                      prettify(i.summary, available_width)))
 
         print(nice_bars)
 
-    def display_detail(self, issue_id):
-        issue = self.rabbit.issue(issue_id)
+    def display_detail(self, issue_id, include_archived=False):
+        issue = self.rabbit.issue(issue_id, include_archived)
 
         print(issue)
 
@@ -502,24 +2955,290 @@ class RabbitConsole:
         for c in issue.comments:
             print(c[1])
 
-if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        usage()
-        sys.exit(1)
+    def display_search(self, query):
+        for result in self.rabbit.search(query):
+            print(result)
+
+def terminal_width():
+    """Return the width of the terminal, in characters, or 80 if there isn't
+    one. COLUMNS overrides it, as for other programs."""
+
+    try:
+        return int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        pass
 
-    if sys.argv[1] == 'init':
+    # output may be piped, e.g. into less, while input is still the terminal
+    for stream in (sys.stdout, sys.stdin):
+        try:
+            return os.get_terminal_size(stream.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            pass
+
+    return 80
+
+def main(argv=None, rabbit=None, term_width=None):
+    """Run a rabbit command line and return its exit status.
+
+    Errors are reported on standard output, as with the rabbit command.
+
+    Keyword arguments:
+    argv -- command line, including the program name. Defaults to sys.argv
+    rabbit -- Rabbit object to use, rather than opening the repository
+    term_width -- width of the terminal output is for
+
+    """
+
+    argv = argv or sys.argv
+    tracer = None
+
+    if _timed(argv):
+        # --timing alone reports the breakdown, but not every statement
+        tracer = Tracer(sys.stderr if _trace_requested(argv) else None)
+        argv = [a for a in argv if a not in ('--trace', '--timing')]
+
+    if len(argv) == 1:
+        usage(argv)
+        return 1
+
+    if argv[1] == 'init':
         try:
             Rabbit.init()
+            return 0
         except RepositoryExistsError as e:
             print('FATAL:', e)
     else:
         try:
-            RabbitConsole()
-            sys.exit(0)
-        except MissingRepositoryError as e:
+            RabbitConsole(argv, rabbit, term_width, tracer)
+            return 0
+        except (MissingRepositoryError, NewerRepositoryError) as e:
             print('FATAL:', e)
-        except (IllegalCommandError, MissingArgumentError, NonexistentIssueError, MissingSummaryError) as e:
+        except (IllegalCommandError, MissingArgumentError, NonexistentIssueError, MissingSummaryError, InvalidSearchError, IllegalFormatError, InvalidCriteriaError, InvalidSettingError, InvalidQueryError, InvalidDateError, InvalidRecordError, getopt.GetoptError) as e:
             print('rabbit:', e)
+        finally:
+            if tracer:
+                print(tracer.timing(), file=sys.stderr)
 
     # if it makes it here, then an error occured
-    sys.exit(1)
+    return 1
+
+def _timed(argv):
+    """Return True if argv asks for the command to be traced or timed, so it
+    must run in this process, rather than on a daemon."""
+
+    return _trace_requested(argv) or '--timing' in argv[1:]
+
+def _trace_requested(argv):
+    """Return True if argv, or the RABBIT_TRACE environment variable, asks
+    for statements to be traced."""
+
+    return '--trace' in argv[1:] or os.environ.get('RABBIT_TRACE', '') not in ('', '0')
+
+# commands the rabbit serve daemon runs on behalf of clients. The rest read
+# standard input, write files, or manage the daemon itself, so always run in
+# the calling process.
+_daemon_commands = ('add', 'update', 'list', 'detail', 'search', 'comment', 'rm', 'close', 'open', 'stats', 'changes', 'explain', 'archive', 'config', 'help')
+
+# daemon commands that don't change the repository, so can safely be run
+# again here when the daemon doesn't answer
+_read_commands = ('list', 'detail', 'search', 'stats', 'changes', 'explain', 'help')
+
+def handle_request(request, rabbit):
+    """Run one command line sent by a client on rabbit, and return the reply.
+
+    Requests and replies are single lines of JSON:
+        {"argv": ["rabbit", "list"], "term_width": 80}
+        {"status": 0, "output": "..."}
+
+    """
+
+    import io
+
+    output = io.StringIO()
+
+    with contextlib.redirect_stdout(output):
+        try:
+            status = main(request['argv'], rabbit, request.get('term_width'))
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            # keep serving; the client reports the failure
+            print('rabbit: {}: {}'.format(type(e).__name__, e))
+            status = 1
+
+    return {'status': status, 'output': output.getvalue()}
+
+
+# seconds a client waits for the daemon to answer before running the command
+# itself, and the daemon waits for a client to send its request or read the reply
+_daemon_timeout = 10
+_request_timeout = 5
+
+def serve():
+    """Serve rabbit commands on the repository's Unix socket until interrupted.
+
+    The socket is kept beside the repository found from the working
+    directory, so commands run anywhere inside the project use it. A
+    single Rabbit object, with its connection and SQLite's cache of
+    prepared statements, is kept open and shared by every request, so
+    clients skip opening and migrating the repository. Requests are handled
+    one at a time.
+
+    """
+
+    import json
+    import signal
+    import socket
+    import socketserver
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        # requests are handled one at a time, so a client that stalls
+        # mustn't hold up the others for long
+        timeout = _request_timeout
+
+        def handle(self):
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                return
+
+            if line:
+                reply = handle_request(json.loads(line.decode()), self.server.rabbit)
+
+                try:
+                    self.wfile.write(json.dumps(reply).encode() + b'\n')
+                except OSError:
+                    # the client gave up waiting
+                    pass
+
+    path = find_repository()
+
+    if path is None:
+        raise MissingRepositoryError()
+
+    socket_filename = os.path.join(path, _socket_filename)
+
+    if os.path.exists(socket_filename):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            probe.connect(socket_filename)
+            print('rabbit: a rabbit daemon is already serving this repository')
+            return 1
+        except OSError:
+            # left behind by a daemon that didn't exit cleanly
+            os.unlink(socket_filename)
+        finally:
+            probe.close()
+
+    server = socketserver.UnixStreamServer(socket_filename, RequestHandler)
+    server.rabbit = Rabbit(path)
+
+    # stop cleanly, removing the socket, when killed as well as interrupted
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print('Serving {} on {}'.format(os.path.join(path, _filename), socket_filename))
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_filename)
+
+    return 0
+
+def _run_via_daemon(argv):
+    """Run argv on a rabbit serve daemon, printing its output.
+
+    Returns the command's exit status, or None if no daemon is running, in
+    which case the caller should run the command itself.
+
+    Once the request is sent the daemon runs it, even if it is too slow to
+    answer within _daemon_timeout seconds, so only commands that don't
+    change the repository are then run here instead. The others fail, as
+    running them again could, e.g., add an issue twice.
+
+    """
+
+    path = find_repository()
+
+    if path is None:
+        return None
+
+    socket_filename = os.path.join(path, _socket_filename)
+
+    # most of the time there is no daemon, so check before importing socket
+    if not os.path.exists(socket_filename):
+        return None
+
+    import json
+    import socket
+
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    request = {'argv': argv}
+
+    if argv[1] == 'list':
+        request['term_width'] = terminal_width()
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(_daemon_timeout)
+
+    try:
+        try:
+            client.connect(socket_filename)
+        except OSError:
+            return None
+
+        try:
+            client.sendall(json.dumps(request).encode() + b'\n')
+            reply = client.makefile('rb').readline()
+        except OSError:
+            # including socket.timeout, from a slow, stopped or hung daemon
+            reply = None
+    finally:
+        client.close()
+
+    if not reply:
+        if argv[1] in _read_commands:
+            return None
+
+        print('rabbit: the rabbit daemon did not answer; check whether the command was done before running it again')
+        return 1
+
+    reply = json.loads(reply.decode())
+    sys.stdout.write(reply['output'])
+
+    return reply['status']
+
+def run():
+    """Run the rabbit command, as given on the command line, and exit.
+
+    Used by the rabbit launcher script, which starts faster than running
+    rabbit.py itself: Python caches the compiled rabbit module, but compiles
+    a script every time it is run.
+
+    """
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        try:
+            sys.exit(serve())
+        except (MissingRepositoryError, NewerRepositoryError) as e:
+            print('FATAL:', e)
+            sys.exit(1)
+
+    # the daemon's repository isn't traced, so traced and timed commands run here
+    if len(sys.argv) > 1 and sys.argv[1] in _daemon_commands and not _timed(sys.argv):
+        status = _run_via_daemon(sys.argv)
+
+        if status is not None:
+            sys.exit(status)
+
+    sys.exit(main())
+
+if __name__ == '__main__':
+    run()
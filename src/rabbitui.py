@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 import sys
 import sqlite3
+import time
 from PyQt4 import QtCore
 from PyQt4 import QtGui
 from PyQt4 import uic
-from PyQt4.QtGui import QTableWidgetItem, QMenu, QMessageBox
+from PyQt4.QtGui import QMenu, QMessageBox
 
 from rabbit import *
 
@@ -16,55 +17,284 @@ Ui_MainWindow, Qt_MainWindow = uic.loadUiType(folder + 'mainwindow.ui');
 Ui_AddWindow, Qt_AddWindow = uic.loadUiType(folder + 'add.ui');
 
 class AddDialog(Qt_AddWindow, Ui_AddWindow):
-    def __init__(self, rabbit, add_dialog=True, modify_issue=None):
+    def __init__(self, add_dialog=True, modify_issue=None):
         super(Qt_AddWindow, self).__init__()
         self.setupUi(self)
         self.setModal(True)
 
-        self.rabbit = rabbit
-
         self.add_dialog = add_dialog
 
         i = Issue()
 
         if not self.add_dialog:
-            self.issue = modify_issue
             self.setWindowTitle('Modify Issue')
             i = modify_issue
 
             self.summary.setText(i.summary)
             self.description.setPlainText(i.description)
 
+        self.issue = i
+
         self.type.setText(i.type)
         self.priority.setText(i.priority)
 
         self.connect(self.buttonBox, QtCore.SIGNAL('accepted()'), self.add)
 
     def add(self):
-        rabbit = self.rabbit
+        """Copy the dialog's fields to self.issue, ready to be saved."""
 
-        summary = self.summary.text()
-        type = self.type.text()
-        priority = self.priority.text()
-        description = self.description.toPlainText()
+        i = self.issue
 
-        i = Issue()
+        i.summary = self.summary.text()
+        i.type = self.type.text()
+        i.priority = self.priority.text()
+        i.description = self.description.toPlainText()
 
-        if not self.add_dialog:
-            i = self.issue
+class RabbitWorker(QtCore.QObject):
+    """Runs jobs against the repository on its own thread.
 
-        i.summary = summary
-        i.type = type
-        i.priority = priority
-        i.description = description
+    The worker opens its own Rabbit, and so its own connection, the first
+    time it runs a job, so the GUI thread never waits on the disk. A job is a
+    callable taking the Rabbit. Its result, or the exception it raised, is
+    sent back with the job's id through finished or failed.
 
-        if self.add_dialog:
-            rabbit.add(i)
+    Results are used on the GUI thread, so jobs must not return anything
+    that reads from the repository later, like IssueRow's lazy description.
+
+    """
+
+    requested = QtCore.pyqtSignal(object, object)
+    finished = QtCore.pyqtSignal(object, object)
+    failed = QtCore.pyqtSignal(object, object)
+
+    def __init__(self):
+        super(RabbitWorker, self).__init__()
+
+        self.rabbit = None
+        self.requested.connect(self.run)
+
+    @QtCore.pyqtSlot(object, object)
+    def run(self, job_id, job):
+        try:
+            if not self.rabbit:
+                try:
+                    self.rabbit = Rabbit()
+                except MissingRepositoryError:
+                    Rabbit.init()
+                    self.rabbit = Rabbit()
+
+            result = job(self.rabbit)
+        except Exception as e:
+            self.failed.emit(job_id, e)
         else:
-            rabbit.update(i)
+            self.finished.emit(job_id, result)
+
+class IssueTableModel(QtCore.QAbstractTableModel):
+    """Table model of the issues matching a query, fetched a page at a time.
+
+    Only the rows the view has asked for are read from the repository. The
+    view asks for more through canFetchMore/fetchMore as it is scrolled, and
+    each page continues from the last issue held, using keyset pagination.
+    Pages are read by the worker, and added when they arrive. Sorting is
+    done by the repository, by re-running the query.
+
+    """
+
+    columns = (('ID', 'i_id'), ('Type', 'type'), ('Date', 'date'),
+               ('Status', 'status'), ('Priority', 'priority'), ('Summary', 'summary'))
+
+    page_size = 200
+
+    # seconds before a page that failed to load is asked for again, doubling
+    # with each failure in a row up to max_retry_delay, so a repository that
+    # keeps failing isn't hammered, and its error isn't shown over and over
+    retry_delay = 1
+    max_retry_delay = 60
+
+    def __init__(self, run_job, query='all'):
+        """Create the model.
+
+        Keyword arguments:
+        run_job -- function taking a job, a callback and an error callback,
+                   as RabbitUI.run_job
+        query -- query for the issues shown
+
+        """
+
+        super(IssueTableModel, self).__init__()
+
+        self.run_job = run_job
+        self.query = query
+        self.sort_field = 'id'
+        self.descending = False
+        self.rows = []
+        self.exhausted = False
+        self.fetching = False
+        self.failures = 0
+        self.retry_at = 0
+
+        # bumped whenever the rows are thrown away, so pages requested
+        # before then are ignored when they arrive
+        self.generation = 0
+
+    def full_query(self):
+        return '{} sort:{}{}'.format(self.query, '-' if self.descending else '', self.sort_field)
+
+    def set_query(self, query):
+        self.query = query
+        self.refresh()
+
+    def refresh(self):
+        """Drop every row held, and start again from the first page."""
+
+        self.beginResetModel()
+        self.rows = []
+        self.exhausted = False
+        self.fetching = False
+        self.failures = 0
+        self.retry_at = 0
+        self.generation += 1
+        self.endResetModel()
+
+    def issue_id(self, row):
+        return self.rows[row].i_id
+
+    def row_of(self, i_id):
+        """Return the row showing the issue with id i_id, or None."""
+
+        for row, issue in enumerate(self.rows):
+            if issue.i_id == i_id:
+                return row
+
+        return None
+
+    def _sort_key(self, issue):
+        field = 'i_id' if self.sort_field == 'id' else self.sort_field
+        return (getattr(issue, field), issue.i_id)
+
+    def patch(self, i_id, issue):
+        """Bring the row for one issue up to date, without reloading the rest.
+
+        Keyword arguments:
+        i_id -- id of the issue that changed
+        issue -- the issue as it is now, or None if it was deleted or no
+                 longer matches the query
+
+        """
+
+        row = self.row_of(i_id)
+
+        if row is not None:
+            self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+            del self.rows[row]
+            self.endRemoveRows()
+
+        if issue is None:
+            return
+
+        key = self._sort_key(issue)
+        position = len(self.rows)
+
+        for row, other in enumerate(self.rows):
+            other_key = self._sort_key(other)
+
+            if (other_key < key) if self.descending else (other_key > key):
+                position = row
+                break
+
+        # past the last row held; a later page will include it
+        if position == len(self.rows) and not self.exhausted:
+            return
+
+        self.beginInsertRows(QtCore.QModelIndex(), position, position)
+        self.rows.insert(position, issue)
+        self.endInsertRows()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None
+
+        return str(getattr(self.rows[index.row()], self.columns[index.column()][1]))
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.columns[section][0]
+
+        return None
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return (not parent.isValid() and not self.exhausted and not self.fetching
+                and time.monotonic() >= self.retry_at)
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        after_id = self.rows[-1].i_id if self.rows else 0
+        query = self.full_query()
+        size = self.page_size
+        generation = self.generation
+
+        self.fetching = True
+        self.run_job(lambda rabbit: list(rabbit.iter_issues(query, page_size=size, after_id=after_id, limit=size)),
+            lambda page: self.page_loaded(generation, page), lambda error: self.page_failed(generation))
+
+    def page_loaded(self, generation, page):
+        if generation != self.generation:
+            return
+
+        self.fetching = False
+        self.failures = 0
+
+        if len(page) < self.page_size:
+            self.exhausted = True
+
+        if not page:
+            return
+
+        self.beginInsertRows(QtCore.QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+        self.rows.extend(page)
+        self.endInsertRows()
+
+    def page_failed(self, generation):
+        if generation != self.generation:
+            return
+
+        # ask for the page again later, e.g. once the database is no longer
+        # locked. Until then canFetchMore is False, so the view can't. Only
+        # the first failure in a row is worth a warning; returns True to
+        # keep quiet about the rest
+        self.fetching = False
+        self.failures += 1
+
+        delay = min(self.retry_delay * 2 ** (self.failures - 1), self.max_retry_delay)
+        self.retry_at = time.monotonic() + delay
+        QtCore.QTimer.singleShot(int(delay * 1000), lambda: self.retry(generation))
+
+        return self.failures > 1
+
+    def retry(self, generation):
+        # timers can fire a little early
+        self.retry_at = 0
+
+        if generation == self.generation and self.canFetchMore():
+            self.fetchMore()
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        self.sort_field = self.columns[column][1].replace('i_id', 'id')
+        self.descending = order == QtCore.Qt.DescendingOrder
+        self.refresh()
+
 
 class RabbitUI(Qt_MainWindow, Ui_MainWindow):
-    rabbit = None
+    model = None
+    warning_shown = False
+
+    # issues either side of the selected one loaded in the background
+    prefetch_rows = 2
 
     def __init__(self):
         super(Qt_MainWindow, self).__init__()
@@ -74,7 +304,6 @@ class RabbitUI(Qt_MainWindow, Ui_MainWindow):
 
         self.issueTable.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         self.connect(self.addButton, QtCore.SIGNAL('clicked()'), self.display_add)
-        self.connect(self.issueTable, QtCore.SIGNAL('itemSelectionChanged()'), self.load_detailed)
         self.connect(self.actionFilter, QtCore.SIGNAL('triggered()'), self.filter)
         self.connect(self.actionComment, QtCore.SIGNAL('triggered()'), self.comment)
         self.connect(self.actionModify, QtCore.SIGNAL('triggered()'), self.modify)
@@ -83,48 +312,134 @@ class RabbitUI(Qt_MainWindow, Ui_MainWindow):
 
         self.filter_text = 'all'
 
+        # every repository access happens on the worker's thread
+        self.jobs = {}
+        self.next_job = 0
+
+        self.worker_thread = QtCore.QThread()
+        self.worker = RabbitWorker()
+        self.worker.moveToThread(self.worker_thread)
+        self.worker.finished.connect(self.job_finished)
+        self.worker.failed.connect(self.job_failed)
+        self.worker_thread.start()
+
+        app.aboutToQuit.connect(self.stop_worker)
+
+    def stop_worker(self):
+        self.worker_thread.quit()
+        self.worker_thread.wait()
+
+    def run_job(self, job, callback=None, errback=None):
+        """Run job on the worker thread, and call callback with its result
+        here, or errback with the exception it raised. Failures are shown to
+        the user, unless errback returns True."""
+
+        self.next_job += 1
+        self.jobs[self.next_job] = (callback, errback)
+        self.worker.requested.emit(self.next_job, job)
+
+    def job_finished(self, job_id, result):
+        callback, errback = self.jobs.pop(job_id)
+
+        if callback:
+            callback(result)
+
+    def job_failed(self, job_id, error):
+        callback, errback = self.jobs.pop(job_id)
+
+        if errback and errback(error):
+            return
+
+        # the warning runs its own event loop, in which more jobs can fail;
+        # show one warning at a time rather than stacking them up
+        if self.warning_shown:
+            return
+
+        self.warning_shown = True
+
+        try:
+            QMessageBox.warning(self, 'Rabbit', str(error))
+        finally:
+            self.warning_shown = False
+
+    def refresh_issue(self, i_id):
+        """Patch the row of an issue that has just changed, and its details."""
+
+        query = '{} id:{}'.format(self.filter_text, i_id)
+
+        def patch(issues):
+            self.model.patch(i_id, issues[0] if issues else None)
+
+            if self.selected_id() == i_id or self.selected_id() is None:
+                self.load_detailed()
+
+        self.run_job(lambda rabbit: list(rabbit.iter_issues(query)), patch)
+
     def display_add(self):
-        a = AddDialog(self.rabbit)
+        a = AddDialog()
         a.exec()
 
         if a.result() == QtGui.QDialog.Accepted:
-            self.load_rabbit()
+            self.run_job(lambda rabbit: rabbit.add(a.issue), self.refresh_issue)
+
+    def selected_row(self):
+        """Return the selected row of the issue table, or None."""
+
+        rows = self.issueTable.selectionModel().selectedRows()
+
+        if len(rows) == 0:
+            return None
+
+        return rows[0].row()
+
+    def selected_id(self):
+        """Return the id of the selected issue, or None."""
+
+        row = self.selected_row()
+
+        if row is None:
+            return None
+
+        return self.model.issue_id(row)
 
     def load_detailed(self):
-        selected = self.issueTable.selectedItems()
-        if len(selected) == 0:
+        id = self.selected_id()
+
+        if id is None:
             self.descriptionLabel.setText('')
             return
 
-        id = selected[0].text()
-        id = int(id)
+        def show(text):
+            # the selection may have moved on while the issue was loading
+            if self.selected_id() == id:
+                self.descriptionLabel.setText(text)
 
-        r = self.rabbit.issue(id)
+        self.run_job(lambda rabbit: repr(rabbit.issue(id)), show)
 
-        self.descriptionLabel.setText(repr(r))
+        # load the issues either side as well, ready for the selection to move
+        row = self.selected_row()
+        neighbours = [self.model.issue_id(r) for r in range(row - self.prefetch_rows, row + self.prefetch_rows + 1)
+                      if r != row and 0 <= r < self.model.rowCount()]
 
-    def load_rabbit(self):
-        if not self.rabbit:
-            try:
-                self.rabbit = Rabbit()
-            except MissingRepositoryError:
-                Rabbit.init()
-                self.rabbit = Rabbit()
+        self.run_job(lambda rabbit: rabbit.prefetch(neighbours))
 
-        issues = self.rabbit.issues(self.filter_text)
-        self.issueTable.setRowCount(len(issues))
+    def load_rabbit(self):
+        if not self.model:
+            self.model = IssueTableModel(self.run_job, self.filter_text)
+            self.issueTable.setModel(self.model)
+            self.issueTable.setWordWrap(True)
 
-        set_item = self.issueTable.setItem
+            self.connect(self.issueTable.selectionModel(),
+                QtCore.SIGNAL('selectionChanged(QItemSelection, QItemSelection)'), self.load_detailed)
+            self.connect(self.model, QtCore.SIGNAL('modelReset()'), self.load_detailed)
 
-        for i, issue in enumerate(issues):
-            set_item(i, 0, QTableWidgetItem(str(issue.i_id)))
-            set_item(i, 1, QTableWidgetItem(issue.type))
-            set_item(i, 2, QTableWidgetItem(issue.date))
-            set_item(i, 3, QTableWidgetItem(issue.status))
-            set_item(i, 4, QTableWidgetItem(issue.priority))
-            set_item(i, 5, QTableWidgetItem(issue.summary))
+            # size the columns to the first page, once it has arrived
+            self.model.rowsInserted.connect(self.size_columns)
+        else:
+            self.model.set_query(self.filter_text)
 
-        self.issueTable.setWordWrap(True)
+    def size_columns(self):
+        self.model.rowsInserted.disconnect(self.size_columns)
         self.issueTable.resizeColumnsToContents()
 
     def right_click(self, position):
@@ -138,26 +453,18 @@ class RabbitUI(Qt_MainWindow, Ui_MainWindow):
         menu.addSeparator()
         menu.addAction('Filter')
 
-        table = self.issueTable
-
         action = menu.exec_(self.issueTable.mapToGlobal(position))
 
-        if action is None:
+        i_id = self.selected_id()
+
+        if action is None or i_id is None:
             return
 
         if action.text() == 'Open':
-            items = table.selectedItems()
-            items[3].setText('open')
-
-            i_id = int(items[0].text())
-            self.rabbit.open([i_id])
+            self.run_job(lambda rabbit: rabbit.open([i_id]), lambda count: self.refresh_issue(i_id))
 
         elif action.text() == 'Close':
-            items = table.selectedItems()
-            items[3].setText('closed')
-
-            i_id = int(items[0].text())
-            self.rabbit.close([i_id])
+            self.run_job(lambda rabbit: rabbit.close([i_id]), lambda count: self.refresh_issue(i_id))
 
         elif action.text() == 'Comment':
             self.comment()
@@ -166,10 +473,8 @@ class RabbitUI(Qt_MainWindow, Ui_MainWindow):
             result = QMessageBox.warning(self, 'Remove this Issue?', 'Are you sure you want delete this issue?', QMessageBox.Yes, QMessageBox.No)
 
             if result == QMessageBox.Yes:
-                items = table.selectedItems()
-                i_id = int(items[0].text())
-                table.removeRow(table.currentRow())
-                self.rabbit.delete(i_id)
+                # only remove the row once the issue is really gone
+                self.run_job(lambda rabbit: rabbit.delete([i_id]), lambda count: self.model.patch(i_id, None))
 
         elif action.text() == 'Modify':
             self.modify()
@@ -177,18 +482,19 @@ class RabbitUI(Qt_MainWindow, Ui_MainWindow):
             self.filter()
 
     def modify(self):
-        items = self.issueTable.selectedItems()
+        i_id = self.selected_id()
 
-        if len(items) == 0:
+        if i_id is None:
             return
 
-        i_id = int(items[0].text())
+        def edit(issue):
+            a = AddDialog(False, issue)
+            a.exec()
 
-        a = AddDialog(self.rabbit, False, self.rabbit.issue(i_id))
-        a.exec()
+            if a.result() == QtGui.QDialog.Accepted:
+                self.run_job(lambda rabbit: rabbit.update(a.issue), lambda result: self.refresh_issue(i_id))
 
-        if a.result() == QtGui.QDialog.Accepted:
-            self.load_rabbit()
+        self.run_job(lambda rabbit: rabbit.issue(i_id), edit)
 
     def comment(self):
         dialog = QtGui.QInputDialog()
@@ -197,20 +503,27 @@ class RabbitUI(Qt_MainWindow, Ui_MainWindow):
 
         if dialog.result() == QtGui.QDialog.Accepted and dialog.textValue():
             t = dialog.textValue()
-            items = self.issueTable.selectedItems()
-            if len(items) == 0:
+            i_id = self.selected_id()
+
+            if i_id is None:
                 return
 
-            i_id = int(items[0].text())
-            self.rabbit.comment(i_id, t)
+            self.run_job(lambda rabbit: rabbit.comment(i_id, t), lambda result: self.load_detailed())
 
     def filter(self):
         dialog = QtGui.QInputDialog()
-        dialog.setLabelText('Status to filter (blank for everything)')
+        dialog.setLabelText('Filter, e.g. status:open priority:high (blank for everything)')
         dialog.exec()
 
         if dialog.result() == QtGui.QDialog.Accepted:
             self.filter_text = dialog.textValue()
+
+            try:
+                parse_query(self.filter_text)
+            except InvalidQueryError as e:
+                QMessageBox.warning(self, 'Invalid filter', str(e))
+                self.filter_text = 'all'
+
             self.load_rabbit()
 
 